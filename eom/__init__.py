@@ -15,7 +15,13 @@
 # limitations under the License.
 
 import gettext
+import sys
 
 __version__ = '0.1'
 
-gettext.install('eom', unicode=1)
+# NOTE(kgriffs): Under Python 3, strings are always unicode, and
+# install() no longer accepts the unicode argument.
+if sys.version_info[0] < 3:
+    gettext.install('eom', unicode=1)
+else:
+    gettext.install('eom')
@@ -0,0 +1,155 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR ONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Non-blocking, batched logging of denied and throttled requests.
+
+Middleware record events by appending them to a bounded queue, which
+is drained by a background thread every flush_interval_sec. Repeats
+of the same event (for example, the same project hammering the same
+forbidden resource) are written as a single line with a count, and
+events that arrive while the queue is full are dropped and counted,
+so that a flood of bad requests never turns into a flood of
+synchronous log I/O on request threads.
+
+The writer thread is started by the first event recorded in each
+process (see eom.service), rather than when the log is created, so
+that prefork servers get one writer per worker.
+"""
+
+import atexit
+import collections
+import os
+
+from oslo.config import cfg
+
+from eom import service
+
+CONF = cfg.CONF
+
+OPT_GROUP_NAME = 'eom:audit'
+OPTIONS = [
+    cfg.IntOpt('max_queued', default=10000),
+    cfg.FloatOpt('flush_interval_sec', default=1.0),
+]
+
+CONF.register_opts(OPTIONS, group=OPT_GROUP_NAME)
+
+
+class AuditLog(service.Service):
+    """Queues log events for a logger and writes them in batches."""
+
+    def __init__(self, logger, max_queued, interval_sec):
+        """Initializes attributes.
+
+        :param logger: logging.Logger to write events to
+        :param max_queued: events to queue before dropping any more
+        :param interval_sec: seconds between flushes
+        """
+        super(AuditLog, self).__init__(interval_sec)
+
+        self.logger = logger
+        self.max_queued = max_queued
+
+        # NOTE(kgriffs): Incremented without a lock, so this may
+        # undercount slightly under contention; it is only reported.
+        self.dropped = 0
+        self._reported_dropped = 0
+
+        # NOTE(kgriffs): deque.append() and popleft() are atomic, so
+        # request threads never wait on the writer.
+        self._events = collections.deque()
+        self._level = logger.getEffectiveLevel()
+
+    def record(self, level, message, **vars):
+        """Queues an event, to be logged as message % vars.
+
+        Starts the writer thread if it isn't running in this process.
+        """
+        if level < self._level:
+            return
+
+        if self._pid != os.getpid():
+            self.start()
+
+        events = self._events
+        if len(events) >= self.max_queued:
+            self.dropped += 1
+            return
+
+        events.append((level, message, vars))
+
+    def flush(self):
+        """Writes all queued events, aggregating repeats."""
+
+        # Pick up any changes to the logging config
+        self._level = self.logger.getEffectiveLevel()
+
+        events = self._events
+        counts = {}
+        batch = []
+        while True:
+            try:
+                level, message, vars = events.popleft()
+            except IndexError:
+                break
+
+            key = (level, message, tuple(sorted(vars.items())))
+            try:
+                counts[key][2] += 1
+            except KeyError:
+                entry = [level, message % vars, 1]
+                counts[key] = entry
+                batch.append(entry)
+
+        for level, line, count in batch:
+            if count > 1:
+                line = _('%(line)s (repeated %(count)d times)') % {
+                    'line': line, 'count': count}
+
+            self.logger.log(level, line)
+
+        dropped = self.dropped
+        if dropped != self._reported_dropped:
+            self.logger.warning(_('Audit queue full; dropped %d events') %
+                                (dropped - self._reported_dropped))
+            self._reported_dropped = dropped
+
+    def tick(self):
+        self.flush()
+
+    def _prepare(self, forked):
+        # NOTE(kgriffs): The parent will write whatever it had queued
+        if forked:
+            self._events = collections.deque()
+            self.dropped = self._reported_dropped = 0
+
+
+def create_audit_log(logger):
+    """Creates an audit log for the given logger.
+
+    Takes configuration from oslo.config.cfg.CONF. The log starts
+    itself once the first event is recorded, and any events still
+    queued when the process exits are written on the way out.
+
+    :param logger: logging.Logger to write events to
+    """
+    group = CONF[OPT_GROUP_NAME]
+
+    audit_log = AuditLog(logger, group['max_queued'],
+                         group['flush_interval_sec'])
+    atexit.register(audit_log.stop)
+
+    return audit_log
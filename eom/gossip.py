@@ -0,0 +1,303 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR ONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Peer-to-peer sharing of governor counters over UDP.
+
+Each governor process periodically sends the requests it has counted
+since its last broadcast to its peers, and adds whatever its peers
+send to its own counters. The governor then makes decisions based on
+an approximate global count, without adding anything to the request
+path. When gossip is enabled, node_count should be left at 1, since
+the counters already reflect traffic across all nodes.
+
+Every process that gossips needs its own gossip_bind address, so
+prefork servers that run several workers per host must give each
+worker a different port (and list all of them as peers). The socket
+is only bound once gossip is started, so a child that starts gossip
+after a fork (see eom.service) closes its copy of any socket that the
+parent bound, and binds its own.
+"""
+
+import logging
+import socket
+import time
+
+import simplejson as json
+
+from eom import service
+
+LOG = logging.getLogger(__name__)
+
+# NOTE(kgriffs): Keep datagrams comfortably under a typical MTU
+MAX_UPDATES_PER_DATAGRAM = 32
+
+
+def _parse_peer(peer):
+    """Parses a "host:port" string into a resolved (ip, port) tuple."""
+    host, port = peer.rsplit(':', 1)
+    return (socket.gethostbyname(host), int(port))
+
+
+def _is_valid(update):
+    """Checks the shape of an update received from a peer.
+
+    Updates are [limit_key, rate_name, epoch, delta] lists, where the
+    limit key is either a string or a list of strings.
+    """
+    if not isinstance(update, list) or len(update) != 4:
+        return False
+
+    limit_key, rate_name, epoch, delta = update
+
+    if isinstance(limit_key, list):
+        if not all(isinstance(part, basestring) for part in limit_key):
+            return False
+    elif not isinstance(limit_key, basestring):
+        return False
+
+    # NOTE(kgriffs): bool is a subclass of int, but never valid here
+    return (isinstance(rate_name, basestring) and
+            isinstance(epoch, (int, long)) and
+            isinstance(delta, (int, long)) and
+            not isinstance(epoch, bool) and
+            not isinstance(delta, bool) and
+            delta > 0)
+
+
+class Gossiper(service.Service):
+    """Shares counter deltas for a Cache with a set of peers.
+
+    The socket is bound by start(), which raises socket.error if the
+    gossip_bind address is already in use.
+    """
+
+    def __init__(self, cache, period_sec, bind, peers, interval_sec):
+        """Initializes attributes.
+
+        :param cache: eom.governor.Cache to share
+        :param period_sec: governor time period, in seconds
+        :param bind: "host:port" to listen on for peer updates
+        :param peers: list of "host:port" strings to send updates to
+        :param interval_sec: seconds between broadcasts
+        """
+        super(Gossiper, self).__init__(interval_sec)
+
+        self.cache = cache
+        self.period_sec = period_sec
+        self.bind = bind
+        self.peers = [_parse_peer(peer) for peer in peers]
+        self._peer_hosts = set(host for host, port in self.peers)
+
+        # NOTE(kgriffs): For each cache key and epoch, tracks how many
+        # local requests were already sent, and how many were merged
+        # in from peers, so that only local deltas are ever broadcast.
+        # State is kept for the previous epoch as well as the current
+        # one, so that whatever was counted just before a roll-over
+        # still gets sent.
+        self._state = {}
+        self._pruned_epoch = None
+
+        self._sock = None
+
+    def _get_state(self, key, epoch):
+        state_key = (key, epoch)
+        try:
+            return self._state[state_key]
+        except KeyError:
+            state = [0, 0]
+            self._state[state_key] = state
+            return state
+
+    def _collect_one(self, updates, key, epoch, count):
+        """Appends the unsent local part of a count, if any."""
+        state = self._get_state(key, epoch)
+        local_count = count - state[1]
+        delta = local_count - state[0]
+
+        if delta > 0:
+            state[0] = local_count
+            limit_key, rate_name = key
+            updates.append([limit_key, rate_name, epoch, delta])
+
+    def collect(self):
+        """Returns local counter deltas accrued since the last call."""
+        current_epoch = int(time.time() / self.period_sec)
+        previous_epoch = current_epoch - 1
+
+        updates = []
+        for key, counters in self.cache.store.items():
+            epoch = counters[0]
+
+            if epoch == current_epoch:
+                # NOTE(kgriffs): Once the counters roll over, whatever
+                # was counted since the last broadcast of the previous
+                # epoch is in the previous count (see Cache.roll_over).
+                if counters[2]:
+                    self._collect_one(updates, key, previous_epoch,
+                                      counters[2])
+
+                self._collect_one(updates, key, epoch, counters[1])
+
+            elif epoch == previous_epoch:
+                self._collect_one(updates, key, epoch, counters[1])
+
+        # Forget about epochs that are too old to matter any more
+        if self._pruned_epoch != current_epoch:
+            for state_key in self._state.keys():
+                if state_key[1] < previous_epoch:
+                    del self._state[state_key]
+
+            self._pruned_epoch = current_epoch
+
+        return updates
+
+    def merge(self, updates):
+        """Adds counter deltas received from a peer to the cache."""
+        get_counters = self.cache.get_counters
+
+        for limit_key, rate_name, epoch, delta in updates:
+            # JSON turns tuples into lists, which are not hashable
+            if isinstance(limit_key, list):
+                limit_key = tuple(limit_key)
+
+            counters = get_counters(limit_key, rate_name)
+
+            if counters[0] == epoch + 1:
+                # Late arrival for what is now the previous epoch
+                counters[2] += delta
+                self.cache.fold(counters, epoch * self.period_sec, delta)
+
+                state = self._get_state((limit_key, rate_name), epoch)
+                state[1] += delta
+                continue
+
+            if counters[0] < epoch:
+                # Roll over, just as calc_sleep would have
+                self.cache.roll_over(counters, epoch, self.period_sec)
+
+            elif counters[0] != epoch:
+                # Too old to matter any more
+                continue
+
+            counters[1] += delta
+            state = self._get_state((limit_key, rate_name), epoch)
+            state[1] += delta
+
+    def broadcast(self):
+        """Sends local counter deltas to all peers."""
+        updates = self.collect()
+
+        for i in range(0, len(updates), MAX_UPDATES_PER_DATAGRAM):
+            datagram = json.dumps(updates[i:i + MAX_UPDATES_PER_DATAGRAM])
+
+            for peer in self.peers:
+                try:
+                    self._sock.sendto(datagram, peer)
+                except socket.error as ex:
+                    LOG.warning(_('Could not send counters to %(peer)s: '
+                                  '%(ex)s') % {'peer': peer, 'ex': ex})
+
+    def receive(self, datagram, address):
+        """Merges a datagram from a peer, ignoring unknown hosts."""
+        if address[0] not in self._peer_hosts:
+            LOG.warning(_('Ignoring counters from unknown host %s') %
+                        address[0])
+            return
+
+        try:
+            updates = json.loads(datagram)
+        except ValueError:
+            LOG.warning(_('Ignoring malformed counters from %s') %
+                        address[0])
+            return
+
+        if not isinstance(updates, list):
+            LOG.warning(_('Ignoring malformed counters from %s') %
+                        address[0])
+            return
+
+        valid_updates = [update for update in updates if _is_valid(update)]
+        if len(valid_updates) != len(updates):
+            LOG.warning(_('Ignoring %(count)d malformed counters from '
+                          '%(host)s') %
+                        {'count': len(updates) - len(valid_updates),
+                         'host': address[0]})
+
+        self.merge(valid_updates)
+
+    def stop(self):
+        """Stops gossiping, sending one last broadcast first."""
+        super(Gossiper, self).stop()
+
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def tick(self):
+        self.broadcast()
+
+    def _prepare(self, forked):
+        # NOTE(kgriffs): A socket inherited from the parent process
+        # belongs to the parent, so just drop this process's copy.
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.bind(_parse_peer(self.bind))
+        except socket.error as ex:
+            sock.close()
+            raise socket.error(ex.errno,
+                               _('Could not bind gossip socket to %(bind)s '
+                                 '(each process needs its own gossip_bind '
+                                 'address): %(ex)s') %
+                               {'bind': self.bind, 'ex': ex})
+
+        self._sock = sock
+
+    def _run(self):
+        next_broadcast = time.time() + self.interval_sec
+
+        while not self._stopped.is_set():
+            timeout = next_broadcast - time.time()
+            if timeout <= 0:
+                try:
+                    self.broadcast()
+                except Exception:
+                    LOG.exception(_('Error broadcasting counters'))
+
+                next_broadcast += self.interval_sec
+                continue
+
+            # NOTE(kgriffs): Wake up at least once per interval so
+            # that stop() doesn't have to wait for a datagram.
+            self._sock.settimeout(timeout)
+            try:
+                datagram, address = self._sock.recvfrom(65535)
+            except socket.timeout:
+                continue
+            except socket.error as ex:
+                LOG.warning(_('Error receiving counters: %s') % ex)
+                continue
+
+            # NOTE(kgriffs): Never let one bad datagram stop gossip
+            # for the life of the process.
+            try:
+                self.receive(datagram, address)
+            except Exception:
+                LOG.exception(_('Error merging counters from %s') %
+                              address[0])
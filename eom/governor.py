@@ -14,12 +14,23 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import array
+import atexit
+import itertools
 import logging
+import math
+import operator
+import os
 import re
 import time
 
 from oslo.config import cfg
-import simplejson as json
+
+from eom import audit
+from eom import gossip
+from eom import profiler
+from eom import rules
+from eom import snapshot
 
 LOG = logging.getLogger(__name__)
 CONF = cfg.CONF
@@ -32,10 +43,60 @@ OPTIONS = [
     cfg.FloatOpt('max_sleep_sec', default=0.5),
     cfg.FloatOpt('sleep_threshold', default=0.1),
     cfg.FloatOpt('sleep_offset', default=0.99),
+
+    # Adaptive limits
+    cfg.FloatOpt('latency_ewma_alpha', default=0.2),
+    cfg.FloatOpt('aimd_increase', default=0.1),
+    cfg.FloatOpt('aimd_decrease', default=0.5),
+
+    # Priority-aware shedding; 0 disables
+    cfg.IntOpt('max_inflight', default=0),
+
+    # Attach X-RateLimit-* and Retry-After headers to responses
+    cfg.BoolOpt('limit_headers', default=True),
+
+    # Peer-to-peer counter sharing; disabled unless gossip_bind is set
+    cfg.StrOpt('gossip_bind'),
+    cfg.ListOpt('gossip_peers', default=[]),
+    cfg.FloatOpt('gossip_interval_sec', default=0.5),
+
+    # Counter persistence across restarts; disabled unless set
+    cfg.StrOpt('snapshot_file'),
+    cfg.FloatOpt('snapshot_interval_sec', default=1.0),
 ]
 
 CONF.register_opts(OPTIONS, group=OPT_GROUP_NAME)
 
+DEFAULT_KEYS = ['HTTP_X_PROJECT_ID']
+
+# NOTE(kgriffs): Fraction of max_inflight above which requests
+# for rates in each priority class are shed. Critical rates are
+# never shed.
+PRIORITY_SHED_RATIOS = {
+    'low': 0.5,
+    'normal': 0.8,
+    'high': 1.0,
+    'critical': None,
+}
+
+
+def _create_key_extractor(keys):
+    """Creates a function that builds a limit key from a WSGI env.
+
+    The returned function raises KeyError if any of the given keys
+    is missing from the env.
+
+    :param keys: list of env keys that together identify the
+        entity being limited. An empty list yields a single, global
+        key for the rate.
+    """
+    if not keys:
+        return lambda env: ''
+
+    # NOTE(kgriffs): itemgetter returns a scalar for a single key and
+    # a tuple otherwise; both are hashable and so make fine dict keys.
+    return operator.itemgetter(*keys)
+
 
 class Rate(object):
     """Represents an individual rate configuration."""
@@ -49,14 +110,33 @@ class Rate(object):
         'soft_limit',
         'hard_limit',
         'target',
+        'penalty_sec',
+        'keys',
+        'get_key',
+        'limits',
+        'latency_sec',
+        'min_soft_limit',
+        'max_soft_limit',
+        'latency_ewma',
+        'adapt_epoch',
+        'priority',
+        'shed_inflight',
+        'limit_header',
+        'windows',
     )
 
-    def __init__(self, document, period_sec, node_count):
+    def __init__(self, document, period_sec, node_count, max_inflight=0):
         """Initializes attributes.
 
         :param dict document:
+        :param max_inflight: (Default 0) number of in-flight requests
+            at which the node is considered saturated, or 0 to
+            disable shedding
         """
         self.name = document['name']
+        self.keys = document.get('keys', DEFAULT_KEYS)
+        self.get_key = _create_key_extractor(self.keys)
+
         if 'route' in document:
             self.route = re.compile(document['route'] + '$')
         else:
@@ -70,6 +150,65 @@ class Rate(object):
         self.hard_limit = document['hard_limit'] / node_count
         self.soft_limit = document['soft_limit'] / node_count
         self.target = float(self.soft_limit) / period_sec
+        self.limit_header = ('X-RateLimit-Limit', str(int(self.soft_limit)))
+
+        # NOTE(kgriffs): When non-zero, a key that crosses the
+        # hard limit is put in the penalty box for this many seconds,
+        # during which requests are rejected without doing any
+        # further accounting.
+        self.penalty_sec = document.get('penalty_sec', 0)
+
+        # NOTE(kgriffs): A rate may declare additional limits that are
+        # enforced simultaneously, each keyed on its own set of env
+        # keys (e.g., per project and per user within the project.)
+        # The rate itself is always the first limit in the list.
+        self.limits = [self]
+        for limit_doc in document.get('limits', []):
+            if 'name' not in limit_doc:
+                limit_doc = dict(limit_doc)
+                limit_doc['name'] = '%s[%s]' % (
+                    self.name, ','.join(limit_doc.get('keys', DEFAULT_KEYS)))
+
+            self.limits.append(Rate(limit_doc, period_sec, node_count))
+
+        # NOTE(kgriffs): When latency_sec is given, the soft limit is
+        # scaled between min_soft_limit and max_soft_limit according
+        # to the latency observed from the wrapped app.
+        self.latency_sec = document.get('latency_sec')
+        self.min_soft_limit = document.get(
+            'min_soft_limit', document['soft_limit'] / 2) / node_count
+        self.max_soft_limit = document.get(
+            'max_soft_limit', document['hard_limit']) / node_count
+        self.latency_ewma = None
+        self.adapt_epoch = None
+
+        # NOTE(kgriffs): Precompute the in-flight count at which this
+        # rate is shed so that the check is a single comparison.
+        self.priority = document.get('priority', 'normal')
+        shed_ratio = PRIORITY_SHED_RATIOS[self.priority]
+        if max_inflight and shed_ratio is not None:
+            self.shed_inflight = int(max_inflight * shed_ratio)
+        else:
+            self.shed_inflight = float('inf')
+
+        # NOTE(kgriffs): Longer windows (e.g., per day) are enforced as
+        # quotas on top of the soft and hard limits. Each is stored as
+        # a (window_sec, window_epoch, count) triple at the given
+        # offset in the key's counters list.
+        self.windows = []
+        for index, window_doc in enumerate(document.get('windows', [])):
+            window_sec = window_doc['period_sec']
+            if window_sec % period_sec:
+                raise ValueError(_('Window of %(window_sec)d sec. for rate '
+                                   'rule "%(name)s" is not a multiple of '
+                                   '%(period_sec)d sec.') %
+                                 {'window_sec': window_sec,
+                                  'name': self.name,
+                                  'period_sec': period_sec})
+
+            offset = WINDOWS + index * 3
+            window_limit = window_doc['limit'] / node_count
+            self.windows.append((offset, window_sec, window_limit))
 
     def applies_to(self, method, path):
         """Determines whether this rate applies to a given request.
@@ -90,24 +229,28 @@ class HardLimitError(Exception):
     pass
 
 
-def _load_rates(path, period_sec, node_count):
-    full_path = CONF.find_file(path)
-    if not full_path:
-        raise cfg.ConfigFilesNotFoundError([path or '<Empty>'])
+# NOTE(kgriffs): Bulk decisions are sleep times, so a rejected request
+# is one that would have to sleep forever.
+REJECT = float('inf')
 
-    with open(full_path) as fd:
-        document = json.load(fd)
 
-    return [Rate(rate_doc, period_sec, node_count)
-            for rate_doc in document]
+def _load_rates(path, period_sec, node_count, max_inflight=0):
+    return [Rate(rate_doc, period_sec, node_count, max_inflight)
+            for rate_doc in rules.load(path, 'rates')]
 
 
-def _get_counter_key(project_id, bucket):
-    return project_id + ':bucket:' + bucket
+def _get_counter_key(limit_key, rate_name):
+    return (limit_key, rate_name)
 
 
-def _get_throttle_key(project_id):
-    return project_id + ':throttle_until'
+# NOTE(kgriffs): Counters for a given (limit key, rate) pair are kept
+# together in a single mutable list so that the hot path needs only
+# one dict lookup and no per-request string building.
+EPOCH = 0
+CURRENT_COUNT = 1
+PREVIOUS_COUNT = 2
+THROTTLE_UNTIL = 3
+WINDOWS = 4
 
 
 # TODO(kgriffs): Consider converting to closure-style
@@ -117,69 +260,142 @@ class Cache(object):
     def __init__(self):
         self.store = {}
 
-    def inc_counter(self, project_id, bucket):
-        key = _get_counter_key(project_id, bucket)
-        try:
-            count = self.store[key] + 1
-            self.store[key] = count
-        except KeyError:
-            count = 1
-            self.store[key] = 1
+    def get_counters(self, limit_key, rate_name):
+        """Returns the counters list for the given limit key and rate.
 
-        return count
-
-    def get_counter(self, project_id, bucket):
-        key = _get_counter_key(project_id, bucket)
+        The list is created on first access and is laid out as
+        [EPOCH, CURRENT_COUNT, PREVIOUS_COUNT, THROTTLE_UNTIL], followed
+        by a (window_sec, window_epoch, count) triple for each of the
+        rate's long windows, if any.
+        """
+        key = _get_counter_key(limit_key, rate_name)
         try:
             return self.store[key]
         except KeyError:
-            return 0
+            counters = [0, 0, 0, 0]
+            self.store[key] = counters
+            return counters
 
-    def reset_counter(self, project_id, bucket):
-        key = _get_counter_key(project_id, bucket)
-        self.store[key] = 0
+    def set_throttle(self, limit_key, rate_name, period_sec, now=None):
+        if now is None:
+            now = time.time()
 
-    def set_throttle(self, project_id, period_sec):
-        key = _get_throttle_key(project_id)
-        self.store[key] = time.time() + period_sec
+        counters = self.get_counters(limit_key, rate_name)
+        counters[THROTTLE_UNTIL] = now + period_sec
 
-    def is_throttled(self, project_id):
-        key = _get_throttle_key(project_id)
+    def is_throttled(self, limit_key, rate_name, now=None):
+        key = _get_counter_key(limit_key, rate_name)
         if key not in self.store:
             return False
 
-        throttle_until = self.store[key]
-        now = time.time()
+        throttle_until = self.store[key][THROTTLE_UNTIL]
+        if now is None:
+            now = time.time()
 
         return now < throttle_until
 
+    def roll_over(self, counters, epoch, period_sec):
+        """Moves the given counters into a new time epoch.
+
+        The count for the epoch that just ended becomes the previous
+        count, unless the key was idle for the entire previous epoch,
+        in which case the previous count is stale and so is cleared.
+        Either way, the count is folded into any long windows.
+        """
+        finished_epoch = counters[EPOCH]
+        finished_count = counters[CURRENT_COUNT]
+
+        if finished_epoch == epoch - 1:
+            counters[PREVIOUS_COUNT] = finished_count
+        else:
+            counters[PREVIOUS_COUNT] = 0
+
+        counters[EPOCH] = epoch
+        counters[CURRENT_COUNT] = 0
+
+        if finished_count:
+            self.fold(counters, finished_epoch * period_sec, finished_count)
+
+    def fold(self, counters, start_sec, count):
+        """Adds a past epoch's count to the counters' long windows.
+
+        :param start_sec: time at which the epoch started
+        """
+        for offset in range(WINDOWS, len(counters), 3):
+            window_epoch = int(start_sec / counters[offset])
+            if counters[offset + 1] == window_epoch:
+                counters[offset + 2] += count
+            elif counters[offset + 1] < window_epoch:
+                counters[offset + 1] = window_epoch
+                counters[offset + 2] = count
+
 
 def _create_calc_sleep(period_sec, cache, sleep_threshold, sleep_offset):
     """Creates a closure with the given params for convenience and perf."""
 
-    ctx = {'last_bucket': None}
+    get_counters = cache.get_counters
+    roll_over = cache.roll_over
+
+    def calc_sleep(limit_key, rate, counters=None):
+        """Counts a request, returning how long it should sleep.
 
-    def calc_sleep(project_id, rate):
-        # Alternate between two buckets of
-        # counters using a time function.
+        :param counters: (Default None) the counters for limit_key and
+            rate, if the caller already has them, to save a lookup
+        :raises HardLimitError: if the request should be rejected
+        """
         now = time.time()
-        normalized = now % (period_sec * 2)
 
-        if normalized < period_sec:
-            current_bucket = 'a'
-            previous_bucket = 'b'
-        else:
-            current_bucket = 'b'
-            previous_bucket = 'a'
+        # NOTE(kgriffs): Counter indices are inlined below (see
+        # EPOCH, CURRENT_COUNT, etc.) to avoid global lookups.
+        if counters is None:
+            counters = get_counters(limit_key, rate.name)
 
-        if ctx['last_bucket'] != current_bucket:
-            cache.reset_counter(project_id, current_bucket)
-            ctx['last_bucket'] = current_bucket
+        # Keys in the penalty box are rejected with a single
+        # timestamp check, skipping the counters altogether.
+        if now < counters[3]:
+            raise HardLimitError()
 
-        current_count = cache.inc_counter(project_id, current_bucket)
-        previous_count = cache.get_counter(project_id, previous_bucket)
+        # Roll the counters over whenever we enter a new time epoch
+        epoch = int(now / period_sec)
+        if counters[0] != epoch:
+            roll_over(counters, epoch, period_sec)
+
+        current_count = counters[1] + 1
+        counters[1] = current_count
+        previous_count = counters[2]
+
+        # NOTE(kgriffs): Long windows only see past epochs' counts,
+        # which are folded in on roll-over, so the request itself is
+        # only counted once, above.
+        for offset, window_sec, window_limit in rate.windows:
+            try:
+                if counters[offset] != window_sec:
+                    # The window's length has been changed since these
+                    # counters were saved (see eom.snapshot), so its
+                    # count is in the wrong units; start it over.
+                    counters[offset:offset + 3] = [window_sec, 0, 0]
+
+                window_epoch = counters[offset + 1]
+            except IndexError:
+                # Counters were created by someone that didn't know
+                # about this rate's windows (e.g., a gossip peer.)
+                counters.extend((window_sec, 0, 0))
+                window_epoch = 0
+
+            current_window = int(now / window_sec)
+            used = current_count
+            if window_epoch == current_window:
+                used += counters[offset + 2]
+
+            if used > window_limit:
+                # Quota exhausted; reject until the window is over
+                counters[3] = (current_window + 1) * window_sec
+                raise HardLimitError()
 
         if previous_count > rate.hard_limit:
+            if rate.penalty_sec:
+                counters[3] = now + rate.penalty_sec
+
             raise HardLimitError()
 
         if previous_count > rate.soft_limit:
@@ -224,17 +440,347 @@ def _create_calc_sleep(period_sec, cache, sleep_threshold, sleep_offset):
     return calc_sleep
 
 
-def _log(level, message, **vars):
-    """Logs at the given level with short-circuiting."""
-    if LOG.getEffectiveLevel() != level:
-        return
+def _create_calc_sleep_bulk(period_sec, cache, sleep_offset,
+                            max_sleep_sec, rates):
+    """Creates a closure that applies calc_sleep to a batch at once.
+
+    Hits for the same project and rate (or just the same rate, when
+    none of its limits are keyed) are grouped, so that the counters
+    for each are looked up and updated once per batch, and the outcome
+    for the whole group is worked out in closed form. The results (and
+    counters) are the same as calling calc_sleep for each hit in turn,
+    except that, just as in the middleware, any sleep longer than
+    max_sleep_sec becomes REJECT.
+
+    The one exception is a rate that nests keyless limits within
+    limits keyed on the project (or vice versa). Groups for different
+    projects then share counters, which are updated a group at a time,
+    in order of each group's first hit, rather than hit by hit.
+
+    :raises: ValueError if any limit is keyed on anything other than
+        the project ID (or on nothing at all), since only project IDs
+        are passed in
+    """
+
+    store = cache.store
+    get_counters = cache.get_counters
+    roll_over = cache.roll_over
+
+    # NOTE(kgriffs): Work out up front how each limit is keyed, so
+    # that a rate that can never be applied fails here, rather than
+    # partway through a batch. A key of None stands for the project.
+    plans = {}
+    for rate in rates:
+        plan = []
+        for limit in rate.limits:
+            if limit.keys == DEFAULT_KEYS:
+                limit_key = None
+            elif not limit.keys:
+                limit_key = ''
+            else:
+                raise ValueError(_('Rate rule "%(name)s" is keyed on '
+                                   '%(keys)s, but only the project ID is '
+                                   'available for bulk accounting') %
+                                 {'name': limit.name,
+                                  'keys': ', '.join(limit.keys)})
+
+            plan.append((limit, limit_key))
+
+        plans[rate.name] = plan
+
+    keyless = set(rate.name for rate in rates
+                  if not any(limit.keys for limit in rate.limits))
+
+    def account(counters, rate, count, now, epoch):
+        """Accounts for count hits on a single key.
+
+        :returns: (accepted, decision) tuple, where the first accepted
+            hits get the given decision, and the rest are rejected
+        """
+        if now < counters[3]:
+            return 0, REJECT
+
+        if counters[0] != epoch:
+            roll_over(counters, epoch, period_sec)
+
+        current_count = counters[1]
+
+        # Find the first hit that would exhaust a long window's quota
+        accepted = count
+        throttle_until = None
+        for offset, window_sec, window_limit in rate.windows:
+            try:
+                if counters[offset] != window_sec:
+                    # NOTE(kgriffs): Same as calc_sleep; see there
+                    counters[offset:offset + 3] = [window_sec, 0, 0]
+
+                window_epoch = counters[offset + 1]
+            except IndexError:
+                counters.extend((window_sec, 0, 0))
+                window_epoch = 0
+
+            current_window = int(now / window_sec)
+            used = current_count
+            if window_epoch == current_window:
+                used += counters[offset + 2]
+
+            room = max(0, int(math.floor(window_limit - used)))
+            if room < accepted:
+                accepted = room
+                throttle_until = (current_window + 1) * window_sec
+
+        previous_count = counters[2]
+        if accepted and previous_count > rate.hard_limit:
+            if rate.penalty_sec:
+                # Only the first hit is counted; the penalty box
+                # turns away the rest.
+                counters[1] = current_count + 1
+                counters[3] = now + rate.penalty_sec
+                return 0, REJECT
+
+            decision = REJECT
+
+        elif previous_count > rate.soft_limit:
+            # NOTE(kgriffs): Same as calc_sleep; see there for details
+            normalized_sec = float(previous_count) / rate.target
+            decision = ((normalized_sec - period_sec) / previous_count *
+                        sleep_offset)
+
+        else:
+            decision = 0.0
+
+        if throttle_until is None:
+            counters[1] = current_count + count
+        else:
+            # The hit that exhausted the quota is still counted
+            counters[1] = current_count + accepted + 1
+            counters[3] = throttle_until
+
+        return accepted, decision
+
+    def calc_sleep_bulk(project_ids, rate_names, now=None):
+        """Returns an array of decisions for (project, rate) pairs."""
+        if now is None:
+            now = time.time()
+
+        if len(project_ids) != len(rate_names):
+            raise ValueError(_('Got %(projects)d project IDs but %(rates)d '
+                               'rate names') %
+                             {'projects': len(project_ids),
+                              'rates': len(rate_names)})
+
+        epoch = int(now / period_sec)
+
+        # NOTE(kgriffs): Hits on a keyless rate all share the same
+        # counters, whatever their project, and so form one group.
+        # Groups are kept in order of their first hit, so that those
+        # sharing counters are applied in (roughly) the same order.
+        groups = {}
+        order = []
+        for index, (project_id, rate_name) in enumerate(
+                itertools.izip(project_ids, rate_names)):
+            if rate_name in keyless:
+                project_id = ''
+
+            group_key = (project_id, rate_name)
+            try:
+                groups[group_key].append(index)
+            except KeyError:
+                groups[group_key] = [index]
+                order.append(group_key)
+
+        # NOTE(kgriffs): Check every rate name before counting any
+        # hits, so that a bad batch leaves the counters untouched.
+        for project_id, rate_name in order:
+            if rate_name not in plans:
+                raise KeyError(rate_name)
+
+        decisions = array.array('d', [0.0]) * len(project_ids)
+
+        for group_key in order:
+            project_id, rate_name = group_key
+            indices = groups[group_key]
+            # Each limit only sees the hits that got past the ones
+            # before it, just as in the middleware.
+            accepted = len(indices)
+            decision = 0.0
+            for limit, limit_key in plans[rate_name]:
+                if limit_key is None:
+                    limit_key = project_id
+
+                counters = store.get((limit_key, limit.name))
+                if counters is None:
+                    counters = get_counters(limit_key, limit.name)
+
+                accepted, limit_decision = account(counters, limit,
+                                                   accepted, now, epoch)
+
+                if limit_decision > decision:
+                    decision = limit_decision
+
+                if not accepted or decision == REJECT:
+                    break
+
+            if decision > max_sleep_sec:
+                decision = REJECT
+
+            if decision == REJECT:
+                accepted = 0
+            elif accepted == len(indices) and not decision:
+                # Fast path: the array is already zeroed
+                continue
+
+            for position, index in enumerate(indices):
+                decisions[index] = decision if position < accepted else REJECT
+
+        return decisions
+
+    return calc_sleep_bulk
+
+
+def create_accountant(cache=None):
+    """Creates a function that accounts for requests in bulk.
+
+    Meant for gateways that receive requests in batches, this applies
+    the configured rates just as the middleware would, but to many
+    requests in one call. Sleeping is left up to the caller.
+
+    Takes configuration from oslo.config.cfg.CONF.
+
+    :param cache: (Default None) Cache to keep counters in; a new
+        one is created when not given
+    :returns: a function, account(project_ids, rate_names, now=None),
+        that returns an array.array of decisions, one per item: 0 to
+        let the request pass, the number of seconds (never more than
+        max_sleep_sec) to delay it, or REJECT. A KeyError is raised
+        for an unknown rate name, and a ValueError if the two lists
+        differ in length, in either case before any hits are counted.
+    :raises: ValueError if a rate is keyed on anything besides the
+        project ID
+    """
+    group = CONF[OPT_GROUP_NAME]
+
+    period_sec = group['period_sec']
+    rates = _load_rates(group['rates_file'], period_sec,
+                        group['node_count'])
+
+    if cache is None:
+        cache = Cache()
+
+    return _create_calc_sleep_bulk(period_sec, cache, group['sleep_offset'],
+                                   group['max_sleep_sec'], rates)
+
+
+def _create_adapt(period_sec, alpha, increase, decrease):
+    """Creates a closure that adjusts soft limits based on latency.
 
-    LOG.log(level, message % vars)
+    Latency is tracked per rate as an exponentially-weighted moving
+    average. Once per period, the soft limit is cut multiplicatively
+    if the average exceeds the rate's latency_sec, and otherwise
+    raised by a fixed step (AIMD.)
 
+    :param alpha: smoothing factor for the moving average
+    :param increase: fraction of max_soft_limit to add per period
+    :param decrease: factor to multiply the soft limit by when
+        the backend is slow
+    """
+
+    def adapt(rate, start):
+        now = time.time()
+        latency_sec = now - start
+        epoch = int(now / period_sec)
+
+        # NOTE(kgriffs): Seed the average with the first sample, rather
+        # than with zero, and don't adjust anything until the next
+        # period, so that the limit isn't moved on a single sample.
+        if rate.latency_ewma is None:
+            rate.latency_ewma = latency_sec
+            rate.adapt_epoch = epoch
+            return
+
+        rate.latency_ewma += alpha * (latency_sec - rate.latency_ewma)
+
+        if epoch == rate.adapt_epoch:
+            return
+
+        rate.adapt_epoch = epoch
+
+        if rate.latency_ewma > rate.latency_sec:
+            soft_limit = max(rate.min_soft_limit,
+                             rate.soft_limit * decrease)
+        else:
+            soft_limit = min(rate.max_soft_limit,
+                             rate.soft_limit + rate.max_soft_limit * increase)
+
+        rate.soft_limit = soft_limit
+        rate.target = float(soft_limit) / period_sec
+        rate.limit_header = ('X-RateLimit-Limit', str(int(soft_limit)))
+
+    return adapt
+
+
+# NOTE(kgriffs): Prebuild the most common header tuples so they
+# don't have to be allocated per request.
+_CONTENT_LENGTH_0 = ('Content-Length', '0')
+_RETRY_AFTER_HEADERS = [('Retry-After', str(sec)) for sec in range(61)]
+
+
+def _retry_after(sec):
+    """Returns a Retry-After header tuple for the given delay."""
+    sec = max(1, int(math.ceil(sec)))
+
+    try:
+        return _RETRY_AFTER_HEADERS[sec]
+    except IndexError:
+        return ('Retry-After', str(sec))
 
-def _http_429(start_response):
+
+def _limit_headers(rate, counters, period_sec, rejected=False):
+    """Returns X-RateLimit-* header tuples for the given counters.
+
+    :param rejected: (Default False) whether the request is being
+        rejected, in which case there is no quota remaining, and the
+        reset time accounts for any penalty
+    """
+    reset = (counters[EPOCH] + 1) * period_sec
+
+    # NOTE(kgriffs): Throttling is driven by the previous epoch's
+    # count, so the current count says nothing about why a request
+    # was rejected; don't invite the client to keep trying.
+    if rejected:
+        remaining = 0
+        reset = max(reset, int(math.ceil(counters[THROTTLE_UNTIL])))
+    else:
+        remaining = max(0, int(rate.soft_limit - counters[CURRENT_COUNT]))
+
+    return [
+        rate.limit_header,
+        ('X-RateLimit-Remaining', str(remaining)),
+        ('X-RateLimit-Reset', str(reset)),
+    ]
+
+
+def _with_headers(start_response, extra_headers):
+    """Wraps start_response to append the given headers."""
+
+    def wrapped(status, headers, exc_info=None):
+        headers.extend(extra_headers)
+
+        if exc_info is None:
+            return start_response(status, headers)
+
+        return start_response(status, headers, exc_info)
+
+    return wrapped
+
+
+def _http_429(start_response, extra_headers=None):
     """Responds with HTTP 429."""
-    start_response('429 Too Many Requests', [('Content-Length', '0')])
+    headers = [_CONTENT_LENGTH_0]
+    if extra_headers:
+        headers.extend(extra_headers)
+
+    start_response('429 Too Many Requests', headers)
 
     # TODO(kgriffs): Return a helpful message in JSON or XML, depending
     # on the accept header.
@@ -243,13 +789,46 @@ def _http_429(start_response):
 
 def _http_400(start_response):
     """Responds with HTTP 400."""
-    start_response('400 Bad Request', [('Content-Length', '0')])
+    start_response('400 Bad Request', [_CONTENT_LENGTH_0])
 
     # TODO(kgriffs): Return a helpful message in JSON or XML, depending
     # on the accept header.
     return []
 
 
+def _start_per_process(app, services):
+    """Wraps an app so that it starts services in each process.
+
+    Rather than being started by wrap(), which a prefork server may
+    call before forking workers, services (see eom.service) are
+    started by the first request each process handles.
+    """
+    getpid = os.getpid
+    started_pid = [None]
+
+    def start():
+        pid = getpid()
+        started_pid[0] = pid
+
+        # NOTE(kgriffs): Services ignore all but the first call to
+        # start() in a given process, so a race here is harmless.
+        for service in services:
+            try:
+                service.start()
+            except Exception:
+                LOG.exception(_('Could not start %s in process %d') %
+                              (type(service).__name__, pid))
+
+    # WSGI callable
+    def middleware(env, start_response):
+        if started_pid[0] != getpid():
+            start()
+
+        return app(env, start_response)
+
+    return middleware
+
+
 # NOTE(kgriffs): Using a functional style since it is more
 # performant than an object-oriented one (middleware should
 # introduce as little overhead as possible.)
@@ -269,67 +848,211 @@ def wrap(app):
     sleep_threshold = group['sleep_threshold']
     sleep_offset = group['sleep_offset']
 
+    max_inflight = group['max_inflight']
+    limit_headers = group['limit_headers']
+
     rates_path = group['rates_file']
-    rates = _load_rates(rates_path, period_sec, node_count)
+    rates = _load_rates(rates_path, period_sec, node_count, max_inflight)
 
     cache = Cache()
     calc_sleep = _create_calc_sleep(period_sec, cache,
                                     sleep_threshold, sleep_offset)
 
-    # WSGI callable
-    def middleware(env, start_response):
-        path = env['PATH_INFO']
-        method = env['REQUEST_METHOD']
-
-        for rate in rates:
-            if rate.applies_to(method, path):
-                break
-        else:
-            LOG.debug(_('Requested path not recognized. Full steam ahead!'))
-            return app(env, start_response)
-
-        try:
-            project_id = env['HTTP_X_PROJECT_ID']
-        except KeyError:
-            LOG.error(_('Request headers did not include X-Project-ID'))
-            return _http_400(start_response)
-
-        try:
-            sleep_sec = calc_sleep(project_id, rate)
-        except HardLimitError:
-            message = _('Hit hard limit of %(rate)d per sec. for '
-                        'project %(project_id)s according to '
-                        'rate rule "%(name)s"')
-
-            hard_rate = rate.hard_limit / period_sec
-            _log(logging.DEBUG, message, rate=hard_rate, project_id=project_id,
-                 name=rate.name)
-
-            return _http_429(start_response)
-
-        if sleep_sec > max_sleep_sec:
-            message = _('Sleep time of %(sleep_sec)f sec. for '
-                        'project %(project_id)s exceeded max'
-                        'sleep time of %(max_sleep_sec)f sec.')
-
-            _log(logging.DEBUG, message, sleep_sec=sleep_sec,
-                 project_id=project_id, max_sleep_sec=max_sleep_sec)
-
-            return _http_429(start_response)
-
-        if sleep_sec != 0:
-            message = _('Sleeping %(sleep_sec)f sec. for '
-                        'project %(project_id)s to limit '
-                        'rate to %(limit)d according to '
-                        'rate rule "%(name)s"')
-
-            _log(logging.DEBUG, message, sleep_sec=sleep_sec,
-                 project_id=project_id, limit=rate.soft_limit, name=rate.name)
-
-            # Keep calm...
-            time.sleep(sleep_sec)
-
-        # ...and carry on.
-        return app(env, start_response)
-
-    return middleware
+    # NOTE(kgriffs): Background services are started lazily, in each
+    # process, so that they survive prefork servers (see
+    # _start_per_process).
+    services = []
+
+    snapshot_path = group['snapshot_file']
+    if snapshot_path:
+        if os.path.exists(snapshot_path):
+            snapshot.load(cache, snapshot_path, period_sec)
+
+        snapshotter = snapshot.Snapshotter(cache, snapshot_path,
+                                           group['snapshot_interval_sec'])
+        services.append(snapshotter)
+
+        # Take one last snapshot on the way out
+        atexit.register(snapshotter.stop)
+
+    if group['gossip_bind']:
+        gossiper = gossip.Gossiper(cache, period_sec, group['gossip_bind'],
+                                   group['gossip_peers'],
+                                   group['gossip_interval_sec'])
+        services.append(gossiper)
+
+    get_counters = cache.get_counters
+
+    # NOTE(kgriffs): Throttled requests are logged from a background
+    # thread, so that logging them costs little more than an append.
+    record = audit.create_audit_log(LOG).record
+
+    adapt = _create_adapt(period_sec, group['latency_ewma_alpha'],
+                          group['aimd_increase'], group['aimd_decrease'])
+
+    # NOTE(kgriffs): Requests are tracked by the id of their env,
+    # since set.add() and set.discard() are atomic and so do not
+    # require a lock.
+    inflight = set()
+
+    # NOTE(kgriffs): The middleware is built by a factory so that the
+    # profiler can create an instrumented copy of it, leaving the
+    # regular one untouched when profiling is disabled.
+    def create_middleware(app, calc_sleep, sleep):
+        # WSGI callable
+        def middleware(env, start_response):
+            path = env['PATH_INFO']
+            method = env['REQUEST_METHOD']
+
+            for rate in rates:
+                if rate.applies_to(method, path):
+                    break
+            else:
+                LOG.debug(_('Requested path not recognized. '
+                            'Full steam ahead!'))
+                return app(env, start_response)
+
+            if not max_inflight:
+                return govern(env, start_response, rate)
+
+            if len(inflight) >= rate.shed_inflight:
+                message = _('Node saturated; shedding request for '
+                            '%(priority)s priority rate rule "%(name)s"')
+
+                record(logging.DEBUG, message, priority=rate.priority,
+                       name=rate.name)
+
+                if limit_headers:
+                    return _http_429(start_response, [_retry_after(1)])
+
+                return _http_429(start_response)
+
+            request_id = id(env)
+            inflight.add(request_id)
+            try:
+                return govern(env, start_response, rate)
+            finally:
+                inflight.discard(request_id)
+
+        def govern(env, start_response, rate):
+            """Applies the given rate to the request."""
+
+            # Enforce each limit declared by the rate, sleeping for
+            # the longest period any one of them calls for.
+            # NOTE(kgriffs): Extract every limit's key before counting
+            # anything, so that a request that gets a 400 is not
+            # counted against any of the limits.
+            limit_keys = []
+            for limit in rate.limits:
+                try:
+                    limit_keys.append(limit.get_key(env))
+                except KeyError:
+                    message = _('Request did not include %(keys)s as required '
+                                'by rate rule "%(name)s"')
+                    record(logging.ERROR, message,
+                           keys=', '.join(limit.keys), name=limit.name)
+                    return _http_400(start_response)
+
+            sleep_sec = 0
+            headers_remaining = float('inf')
+            for limit, limit_key in zip(rate.limits, limit_keys):
+                counters = get_counters(limit_key, limit.name)
+                try:
+                    limit_sleep_sec = calc_sleep(limit_key, limit, counters)
+                except HardLimitError:
+                    message = _('Hit hard limit of %(rate)d per sec. for '
+                                '%(limit_key)s according to '
+                                'rate rule "%(name)s"')
+
+                    hard_rate = limit.hard_limit / period_sec
+                    record(logging.DEBUG, message, rate=hard_rate,
+                           limit_key=limit_key, name=limit.name)
+
+                    if not limit_headers:
+                        return _http_429(start_response)
+
+                    # Retry once the current epoch (or penalty) is over
+                    retry_at = max((counters[0] + 1) * period_sec, counters[3])
+
+                    headers = _limit_headers(limit, counters, period_sec,
+                                             rejected=True)
+                    headers.append(_retry_after(retry_at - time.time()))
+                    return _http_429(start_response, headers)
+
+                if limit_sleep_sec > sleep_sec:
+                    sleep_sec = limit_sleep_sec
+                    sleep_limit = limit
+                    sleep_key = limit_key
+
+                # Report on whichever limit has the least headroom
+                if limit_headers:
+                    remaining = limit.soft_limit - counters[1]
+                    if remaining < headers_remaining:
+                        headers_counters = counters
+                        headers_limit = limit
+                        headers_remaining = remaining
+
+            if sleep_sec > max_sleep_sec:
+                # NOTE(kgriffs): Leave out the exact sleep time so that
+                # repeats for the same key are aggregated.
+                message = _('Sleep time for %(limit_key)s exceeded max '
+                            'sleep time of %(max_sleep_sec)f sec. '
+                            'according to rate rule "%(name)s"')
+
+                record(logging.DEBUG, message, limit_key=sleep_key,
+                       max_sleep_sec=max_sleep_sec, name=sleep_limit.name)
+
+                if limit_headers:
+                    headers = _limit_headers(headers_limit, headers_counters,
+                                             period_sec, rejected=True)
+                    headers.append(_retry_after(sleep_sec))
+                    return _http_429(start_response, headers)
+
+                return _http_429(start_response)
+
+            if sleep_sec != 0:
+                # NOTE(kgriffs): Leave out the exact sleep time so that
+                # repeats for the same key are aggregated.
+                message = _('Sleeping to limit %(limit_key)s to '
+                            '%(limit)d according to rate rule "%(name)s"')
+
+                record(logging.DEBUG, message, limit_key=sleep_key,
+                       limit=sleep_limit.soft_limit, name=sleep_limit.name)
+
+                # Keep calm...
+                sleep(sleep_sec)
+
+            # ...and carry on.
+            if limit_headers:
+                headers = _limit_headers(headers_limit, headers_counters,
+                                         period_sec)
+                start_response = _with_headers(start_response, headers)
+
+            if rate.latency_sec is None:
+                return app(env, start_response)
+
+            # NOTE(kgriffs): Only the call into the app is timed, not
+            # iteration over the response body.
+            start = time.time()
+            response = app(env, start_response)
+            adapt(rate, start)
+
+            return response
+
+        return middleware
+
+    middleware = create_middleware(app, calc_sleep, time.sleep)
+
+    stage_profiler = profiler.get_profiler('governor')
+    if stage_profiler is not None:
+        timed_middleware = create_middleware(
+            stage_profiler.timed('app', app),
+            stage_profiler.timed('counters', calc_sleep),
+            stage_profiler.timed('sleep', time.sleep))
+
+        middleware = stage_profiler.sampled(middleware, timed_middleware)
+
+    if services:
+        middleware = _start_per_process(middleware, services)
+
+    return profiler.wrap(middleware)
@@ -0,0 +1,324 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR ONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Linter and compiler for governor and RBAC rule files.
+
+Validates rates and ACL rule files, reporting rules that can never
+match because an earlier rule always wins (both middlewares stop at
+the first match), along with routes that are prone to catastrophic
+backtracking. Optionally emits a single policy artifact containing
+the validated rule sets, which may be used in place of either file
+via the rates_file and acls_file options. Only the rule sets that
+were given are included, and middleware refuses to load an artifact
+that lacks the section it needs.
+
+Usage::
+
+    eom-policy --rates governor.json --acls rbac.json -o eom.policy
+"""
+
+from __future__ import print_function
+
+import optparse
+import re
+import sre_constants
+import sre_parse
+import sys
+
+import simplejson as json
+
+import eom.governor
+import eom.rbac
+from eom import rules
+
+ERROR = 'error'
+WARNING = 'warning'
+
+_REPEATS = (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT)
+
+try:
+    _unichr = unichr
+except NameError:
+    # Python 3
+    _unichr = chr
+
+
+def _subpatterns(value):
+    """Yields each parsed subpattern nested within a node's value."""
+    if isinstance(value, sre_parse.SubPattern):
+        yield value
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            for subpattern in _subpatterns(item):
+                yield subpattern
+
+
+def _has_unbounded_repeat(subpattern):
+    for op, value in subpattern:
+        if op in _REPEATS and value[1] == sre_constants.MAXREPEAT:
+            return True
+
+        for child in _subpatterns(value):
+            if _has_unbounded_repeat(child):
+                return True
+
+    return False
+
+
+def backtracking_risk(pattern):
+    """Determines whether a regex nests unbounded quantifiers.
+
+    Patterns such as "(a+)+" can take exponential time to fail
+    a match, which an attacker can trigger with a crafted path.
+
+    :param str pattern: regular expression to check
+    """
+    def check(subpattern):
+        for op, value in subpattern:
+            if op in _REPEATS and value[1] == sre_constants.MAXREPEAT:
+                if _has_unbounded_repeat(value[2]):
+                    return True
+
+            for child in _subpatterns(value):
+                if check(child):
+                    return True
+
+        return False
+
+    return check(sre_parse.parse(pattern))
+
+
+def _literal_path(pattern):
+    """Returns the path a route matches if it has no regex syntax."""
+    chars = []
+    for op, value in sre_parse.parse(pattern):
+        if op != sre_constants.LITERAL:
+            return None
+
+        chars.append(_unichr(value))
+
+    return ''.join(chars)
+
+
+def _covers(earlier, later):
+    """Determines whether the earlier rule matches all that later does.
+
+    Each rule is given as a (route, methods) tuple, where either may
+    be None to mean "anything". Routes are compared exactly, except
+    that a later route with no regex syntax is checked against the
+    earlier route directly.
+    """
+    earlier_route, earlier_methods = earlier
+    route, methods = later
+
+    if earlier_methods is not None:
+        if methods is None or not set(methods) <= set(earlier_methods):
+            return False
+
+    if earlier_route is None or earlier_route == route:
+        return True
+
+    if route is None:
+        return False
+
+    path = _literal_path(route)
+    return (path is not None and
+            re.match(earlier_route + '$', path) is not None)
+
+
+def _lint_routes(source, rules, problems):
+    """Checks routes for shadowing and backtracking risk.
+
+    :param rules: list of (name, route, methods) tuples
+    """
+    for index, (name, route, methods) in enumerate(rules):
+        if route is not None and backtracking_risk(route):
+            problems.append((WARNING, source, name,
+                             _('route "%s" nests unbounded quantifiers and '
+                               'may backtrack catastrophically') % route))
+
+        for earlier_name, earlier_route, earlier_methods in rules[:index]:
+            if _covers((earlier_route, earlier_methods), (route, methods)):
+                problems.append((ERROR, source, name,
+                                 _('unreachable; shadowed by earlier rule '
+                                   '"%s"') % earlier_name))
+                break
+
+
+def lint_rates(source, documents):
+    """Validates a list of rate documents.
+
+    :returns: list of (level, source, rule name, message) tuples
+    """
+    problems = []
+    routes = []
+    names = set()
+
+    for index, document in enumerate(documents):
+        name = document.get('name', '#%d' % index)
+
+        try:
+            rate = eom.governor.Rate(document, 1, 1)
+        except (KeyError, TypeError, ValueError, re.error) as ex:
+            problems.append((ERROR, source, name,
+                             _('invalid rate: %r') % ex))
+            continue
+
+        if name in names:
+            problems.append((ERROR, source, name, _('duplicate name')))
+
+        names.add(name)
+
+        if rate.soft_limit > rate.hard_limit:
+            problems.append((WARNING, source, name,
+                             _('soft_limit exceeds hard_limit')))
+
+        if rate.methods is not None and not rate.methods:
+            problems.append((ERROR, source, name,
+                             _('unreachable; methods list is empty')))
+
+        routes.append((name, document.get('route'),
+                       document.get('methods')))
+
+    _lint_routes(source, routes, problems)
+    return problems
+
+
+def lint_acls(source, rules):
+    """Validates a list of RBAC rules.
+
+    :returns: list of (level, source, resource, message) tuples
+    """
+    problems = []
+    routes = []
+
+    for index, rule in enumerate(rules):
+        name = rule.get('resource', '#%d' % index)
+
+        try:
+            eom.rbac._create_acl_map([rule])
+        except (KeyError, TypeError, AttributeError, re.error) as ex:
+            problems.append((ERROR, source, name,
+                             _('invalid rule: %r') % ex))
+            continue
+
+        if not rule['acl']:
+            problems.append((ERROR, source, name,
+                             _('acl is empty; requests would fail')))
+
+        unknown = set(rule['acl'] or []) - set(['read', 'write', 'delete'])
+        if unknown:
+            problems.append((WARNING, source, name,
+                             _('unknown acl keys: %s') %
+                             ', '.join(sorted(unknown))))
+
+        routes.append((name, rule['route'], None))
+
+    _lint_routes(source, routes, problems)
+    return problems
+
+
+def compile_policy(rates=None, acls=None):
+    """Returns a policy artifact for the given rates and ACL rules.
+
+    Sections that are not given are left out of the artifact.
+    """
+    policy = {'eom_policy': rules.POLICY_VERSION}
+
+    if rates is not None:
+        policy['rates'] = rates
+
+    if acls is not None:
+        policy['acls'] = acls
+
+    return policy
+
+
+def _read(path):
+    """Parses a JSON rules file."""
+    with open(path) as fd:
+        return json.load(fd)
+
+
+def _load(path, section, problems):
+    """Reads rules from a file, reporting any failure as a problem.
+
+    :param section: section to take from a policy artifact
+    :returns: the list of rules, or None if they could not be read
+    """
+    try:
+        document = rules.get_section(_read(path), section)
+    except (IOError, ValueError) as ex:
+        problems.append((ERROR, path, section,
+                         _('could not load rules: %s') % ex))
+        return None
+
+    if not isinstance(document, list):
+        problems.append((ERROR, path, section,
+                         _('expected a list of rules')))
+        return None
+
+    return document
+
+
+def main(argv=None):
+    """Lints rule files, optionally compiling a policy artifact.
+
+    :returns: 1 if any errors were found, otherwise 0
+    """
+    parser = optparse.OptionParser(
+        usage='%prog [--rates FILE] [--acls FILE] [-o OUTPUT]')
+    parser.add_option('--rates', help='governor rates file to check')
+    parser.add_option('--acls', help='RBAC rules file to check')
+    parser.add_option('-o', '--output',
+                      help='write a compiled policy artifact here')
+    parser.add_option('--strict', action='store_true', default=False,
+                      help='treat warnings as errors')
+
+    options, args = parser.parse_args(argv)
+    if not (options.rates or options.acls):
+        parser.error(_('at least one of --rates or --acls is required'))
+
+    rates = acls = None
+    problems = []
+
+    if options.rates:
+        rates = _load(options.rates, 'rates', problems)
+        if rates is not None:
+            problems.extend(lint_rates(options.rates, rates))
+
+    if options.acls:
+        acls = _load(options.acls, 'acls', problems)
+        if acls is not None:
+            problems.extend(lint_acls(options.acls, acls))
+
+    for level, source, name, message in problems:
+        print('%s: %s: "%s": %s' % (source, level, name, message),
+              file=sys.stderr)
+
+    failing = [ERROR, WARNING] if options.strict else [ERROR]
+    if any(problem[0] in failing for problem in problems):
+        return 1
+
+    if options.output:
+        with open(options.output, 'w') as fd:
+            json.dump(compile_policy(rates, acls), fd)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,255 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR ONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Sampling, per-stage latency profiler for the middleware.
+
+When enabled, the middleware sends one in every sample_every requests
+through an instrumented copy of itself that times each stage (such as
+counter updates, sleeping, or the downstream app) into fixed-size,
+log2-bucketed histograms. Time not attributed to any stage (route
+matching and the like) is recorded under the "middleware" stage.
+
+Histograms are dumped to the log on dump_signal, and served as JSON
+at dump_path by any middleware wrapped with this module's wrap().
+When sample_every is 0, the middleware are built exactly as before,
+so profiling costs nothing at all.
+
+Note that dump_path is answered by the outermost middleware, before
+RBAC (or anything else in the pipeline) ever sees the request, so
+the profile is available to any client that can reach the app. Only
+set dump_path on deployments where that path is blocked in front of
+the app (e.g., at the load balancer), or rely on dump_signal instead.
+
+The pyrox filter (eom.rbac_pyrox) returns a decision to pyrox rather
+than calling the upstream itself, so it has no stages to time, and
+reports only its "total" (and the equal "middleware") histogram.
+"""
+
+import itertools
+import logging
+import math
+import signal
+import threading
+import time
+
+from oslo.config import cfg
+import simplejson as json
+
+LOG = logging.getLogger(__name__)
+CONF = cfg.CONF
+
+OPT_GROUP_NAME = 'eom:profiler'
+OPTIONS = [
+    cfg.IntOpt('sample_every', default=0),
+    cfg.StrOpt('dump_signal'),
+    cfg.StrOpt('dump_path'),
+]
+
+CONF.register_opts(OPTIONS, group=OPT_GROUP_NAME)
+
+# NOTE(kgriffs): Bucket i counts samples of less than 2^i usec, so
+# the last bucket covers anything over ~8 sec.
+NUM_BUCKETS = 24
+
+_PROFILERS = {}
+_SIGNAL_INSTALLED = []
+
+
+class Histogram(object):
+    """Fixed-size histogram of durations."""
+
+    __slots__ = ('counts', 'count', 'total_sec')
+
+    def __init__(self):
+        self.counts = [0] * NUM_BUCKETS
+        self.count = 0
+        self.total_sec = 0.0
+
+    def record(self, sec):
+        # NOTE(kgriffs): frexp gives the bit length of the duration in
+        # usec, which is the index of its log2 bucket.
+        index = math.frexp(sec * 1000000)[1]
+        if index < 0:
+            index = 0
+        elif index >= NUM_BUCKETS:
+            index = NUM_BUCKETS - 1
+
+        self.counts[index] += 1
+        self.count += 1
+        self.total_sec += sec
+
+    def percentile(self, percent):
+        """Returns the upper bound, in usec, of the given percentile."""
+        threshold = self.count * percent / 100.0
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= threshold:
+                return 2 ** index
+
+        return 2 ** (NUM_BUCKETS - 1)
+
+    def to_dict(self):
+        mean_usec = 0
+        if self.count:
+            mean_usec = self.total_sec * 1000000 / self.count
+
+        return {
+            'count': self.count,
+            'mean_usec': mean_usec,
+            'p50_usec': self.percentile(50),
+            'p99_usec': self.percentile(99),
+            'buckets': self.counts,
+        }
+
+
+class Profiler(object):
+    """Collects per-stage histograms for a single middleware."""
+
+    def __init__(self, name, sample_every):
+        self.name = name
+        self.sample_every = sample_every
+        self.histograms = {}
+
+        self._counter = itertools.count()
+        self._local = threading.local()
+
+    def histogram(self, stage):
+        try:
+            return self.histograms[stage]
+        except KeyError:
+            histogram = Histogram()
+            self.histograms[stage] = histogram
+            return histogram
+
+    def timed(self, stage, func):
+        """Wraps a callable so that each call is timed as a stage."""
+        histogram = self.histogram(stage)
+        local = self._local
+
+        def timed_func(*args):
+            start = time.time()
+            try:
+                return func(*args)
+            finally:
+                elapsed = time.time() - start
+                histogram.record(elapsed)
+                local.attributed += elapsed
+
+        return timed_func
+
+    def sampled(self, func, timed_func):
+        """Returns a callable that sends 1 in N calls to timed_func.
+
+        The total time of each sampled call is recorded, along with
+        whatever part of it was not attributed to any timed stage.
+        """
+        counter = self._counter
+        sample_every = self.sample_every
+        total = self.histogram('total')
+        middleware = self.histogram('middleware')
+        local = self._local
+
+        def dispatch(*args):
+            if next(counter) % sample_every:
+                return func(*args)
+
+            local.attributed = 0.0
+            start = time.time()
+            try:
+                return timed_func(*args)
+            finally:
+                elapsed = time.time() - start
+                total.record(elapsed)
+                middleware.record(elapsed - local.attributed)
+
+        return dispatch
+
+    def to_dict(self):
+        return dict((stage, histogram.to_dict())
+                    for stage, histogram in self.histograms.items())
+
+
+def dump():
+    """Returns histograms for all profilers as a dict."""
+    return dict((name, profiler.to_dict())
+                for name, profiler in _PROFILERS.items())
+
+
+def _log_dump(signum, frame):
+    LOG.info(_('Middleware profile: %s') % json.dumps(dump()))
+
+
+def _install_signal(name):
+    if _SIGNAL_INSTALLED:
+        return
+
+    try:
+        signal.signal(getattr(signal, name), _log_dump)
+    except (AttributeError, ValueError) as ex:
+        LOG.warning(_('Could not install profile dump handler for '
+                      '%(name)s: %(ex)s') % {'name': name, 'ex': ex})
+        return
+
+    _SIGNAL_INSTALLED.append(name)
+
+
+def get_profiler(name):
+    """Returns the profiler for a middleware, or None if disabled.
+
+    Takes configuration from oslo.config.cfg.CONF.
+
+    :param name: name to report the middleware's histograms under
+    """
+    group = CONF[OPT_GROUP_NAME]
+    if not group['sample_every']:
+        return None
+
+    if group['dump_signal']:
+        _install_signal(group['dump_signal'])
+
+    profiler = Profiler(name, group['sample_every'])
+    _PROFILERS[name] = profiler
+
+    return profiler
+
+
+def wrap(app):
+    """Wrap a WSGI app to serve profiles at dump_path, if enabled.
+
+    Takes configuration from oslo.config.cfg.CONF. Requests for
+    dump_path are answered here without any authorization check,
+    so the path must not be reachable by untrusted clients.
+
+    :param app: WSGI app to wrap
+    :returns: a new WSGI app that wraps the original, or the
+        original app if profiling or the endpoint is disabled
+    """
+    group = CONF[OPT_GROUP_NAME]
+    dump_path = group['dump_path']
+    if not (group['sample_every'] and dump_path):
+        return app
+
+    def middleware(env, start_response):
+        if env['PATH_INFO'] != dump_path:
+            return app(env, start_response)
+
+        body = json.dumps(dump())
+        start_response('200 OK', [('Content-Type', 'application/json'),
+                                  ('Content-Length', str(len(body)))])
+        return [body]
+
+    return middleware
@@ -18,7 +18,10 @@ import logging
 import re
 
 from oslo.config import cfg
-import simplejson as json
+
+from eom import audit
+from eom import profiler
+from eom import rules
 
 LOG = logging.getLogger(__name__)
 CONF = cfg.CONF
@@ -32,12 +35,7 @@ EMPTY_SET = set()
 
 
 def _load_rules(path):
-    full_path = CONF.find_file(path)
-    if not full_path:
-        raise cfg.ConfigFilesNotFoundError([path])
-
-    with open(full_path) as fd:
-        return json.load(fd)
+    return rules.load(path, 'acls')
 
 
 def _create_acl_map(rules):
@@ -95,40 +93,68 @@ def wrap(app):
     rules = _load_rules(rules_path)
     acl_map = _create_acl_map(rules)
 
-    # WSGI callable
-    def middleware(env, start_response):
-        path = env['PATH_INFO']
-        for resource, route, acl in acl_map:
-            if route.match(path):
-                break
-        else:
-            LOG.debug(_('Requested path not recognized. Skipping RBAC.'))
-            return app(env, start_response)
-
-        try:
-            roles = env['HTTP_X_ROLES']
-        except KeyError:
-            LOG.error(_('Request headers did not include X-Roles'))
+    # NOTE(kgriffs): Denials are logged from a background thread so
+    # that a client hammering forbidden resources can't tie up
+    # request threads with log I/O.
+    audit_log = audit.create_audit_log(LOG)
+    record = audit_log.record
+
+    # NOTE(kgriffs): The middleware is built by a factory so that the
+    # profiler can create an instrumented copy of it, leaving the
+    # regular one untouched when profiling is disabled.
+    def create_middleware(app):
+        # WSGI callable
+        def middleware(env, start_response):
+            path = env['PATH_INFO']
+            for resource, route, acl in acl_map:
+                if route.match(path):
+                    break
+            else:
+                LOG.debug(_('Requested path not recognized. Skipping RBAC.'))
+                return app(env, start_response)
+
+            project_id = env.get('HTTP_X_PROJECT_ID')
+
+            try:
+                roles = env['HTTP_X_ROLES']
+            except KeyError:
+                record(logging.ERROR,
+                       _('Request headers did not include X-Roles '
+                         '(project %(project_id)s)'),
+                       project_id=project_id)
+                return _http_forbidden(start_response)
+
+            given_roles = set(roles.split(',')) if roles else EMPTY_SET
+
+            method = env['REQUEST_METHOD']
+            try:
+                authorized_roles = acl[method]
+            except KeyError:
+                record(logging.ERROR,
+                       _('HTTP method not supported: %(method)s '
+                         '(project %(project_id)s)'),
+                       method=method, project_id=project_id)
+                return _http_forbidden(start_response)
+
+            # The user must have one of the roles that
+            # is authorized for the requested method.
+            if (authorized_roles & given_roles):
+                # Carry on
+                return app(env, start_response)
+
+            record(logging.INFO,
+                   _('User not authorized to %(method)s the %(resource)s '
+                     'resource (project %(project_id)s)'),
+                   method=method, resource=resource, project_id=project_id)
             return _http_forbidden(start_response)
 
-        given_roles = set(roles.split(',')) if roles else EMPTY_SET
-
-        method = env['REQUEST_METHOD']
-        try:
-            authorized_roles = acl[method]
-        except KeyError:
-            LOG.error(_('HTTP method not supported: %s') % method)
-            return _http_forbidden(start_response)
+        return middleware
 
-        # The user must have one of the roles that
-        # is authorized for the requested method.
-        if (authorized_roles & given_roles):
-            # Carry on
-            return app(env, start_response)
+    middleware = create_middleware(app)
 
-        logline = _('User not authorized to %(method)s '
-                    'the %(resource)s resource')
-        LOG.info(logline % {'method': method, 'resource': resource})
-        return _http_forbidden(start_response)
+    stage_profiler = profiler.get_profiler('rbac')
+    if stage_profiler is not None:
+        timed_middleware = create_middleware(stage_profiler.timed('app', app))
+        middleware = stage_profiler.sampled(middleware, timed_middleware)
 
-    return middleware
+    return profiler.wrap(middleware)
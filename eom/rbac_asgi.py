@@ -0,0 +1,171 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR ONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""RBAC middleware for ASGI (version 3) servers, such as uvicorn.
+
+Applies the same rules (or compiled policy artifact) as eom.rbac,
+taking configuration from the same eom:rbac group, without having to
+run a WSGI app on a thread pool.
+
+The middleware is a plain callable that returns an awaitable, rather
+than a coroutine function, so that this module remains valid under
+Python 2. Authorized requests are handed the downstream app's
+awaitable as-is, so they don't pay for an extra coroutine. Servers
+that guess the interface version from the app (e.g., uvicorn's
+"auto" mode) should be told that it is "asgi3".
+"""
+
+import logging
+
+from eom import audit
+from eom import rbac
+
+LOG = logging.getLogger(__name__)
+CONF = rbac.CONF
+
+EMPTY_SET = frozenset()
+
+_403_FORBIDDEN = (
+    {
+        'type': 'http.response.start',
+        'status': 403,
+        'headers': [(b'content-length', b'0')],
+    },
+    {
+        'type': 'http.response.body',
+        'body': b'',
+    },
+)
+
+
+class _Response(object):
+    """Awaitable that sends the given ASGI messages in turn."""
+
+    __slots__ = ('send', 'messages')
+
+    def __init__(self, send, messages):
+        self.send = send
+        self.messages = messages
+
+    def __await__(self):
+        # NOTE(kgriffs): Delegate to each send() awaitable by hand,
+        # just as "yield from" would (see PEP 380), since that syntax
+        # isn't available under Python 2.
+        for message in self.messages:
+            iterator = self.send(message).__await__()
+            sent = None
+            thrown = None
+
+            while True:
+                try:
+                    if thrown is not None:
+                        value = iterator.throw(*thrown)
+                    elif sent is None:
+                        value = next(iterator)
+                    else:
+                        value = iterator.send(sent)
+                except StopIteration:
+                    break
+
+                sent = thrown = None
+                try:
+                    sent = yield value
+                except GeneratorExit:
+                    close = getattr(iterator, 'close', None)
+                    if close is not None:
+                        close()
+
+                    raise
+                except BaseException as ex:
+                    thrown = (type(ex), ex)
+
+
+def _http_forbidden(send):
+    """Responds with HTTP 403."""
+    return _Response(send, _403_FORBIDDEN)
+
+
+# NOTE(kgriffs): Using a functional style since it is more
+# performant than an object-oriented one (middleware should
+# introduce as little overhead as possible.)
+def wrap(app):
+    """Wrap an ASGI app with ACL middleware.
+
+    Takes configuration from oslo.config.cfg.CONF.
+
+    :param app: ASGI 3 app to wrap
+    :returns: a new ASGI 3 app that wraps the original
+    """
+    group = CONF[rbac.OPT_GROUP_NAME]
+    rules_path = group[rbac.OPTION_NAME]
+    rules = rbac._load_rules(rules_path)
+    acl_map = rbac._create_acl_map(rules)
+
+    record = audit.create_audit_log(LOG).record
+
+    # ASGI callable
+    def middleware(scope, receive, send):
+        if scope['type'] != 'http':
+            return app(scope, receive, send)
+
+        path = scope['path']
+        for resource, route, acl in acl_map:
+            if route.match(path):
+                break
+        else:
+            LOG.debug(_('Requested path not recognized. Skipping RBAC.'))
+            return app(scope, receive, send)
+
+        # NOTE(kgriffs): Header names are always lowercase in ASGI
+        roles = project_id = None
+        for name, value in scope['headers']:
+            if name == b'x-roles':
+                roles = value.decode('latin-1')
+            elif name == b'x-project-id':
+                project_id = value.decode('latin-1')
+
+        if roles is None:
+            record(logging.ERROR,
+                   _('Request headers did not include X-Roles '
+                     '(project %(project_id)s)'),
+                   project_id=project_id)
+            return _http_forbidden(send)
+
+        given_roles = set(roles.split(',')) if roles else EMPTY_SET
+
+        method = scope['method']
+        try:
+            authorized_roles = acl[method]
+        except KeyError:
+            record(logging.ERROR,
+                   _('HTTP method not supported: %(method)s '
+                     '(project %(project_id)s)'),
+                   method=method, project_id=project_id)
+            return _http_forbidden(send)
+
+        # The user must have one of the roles that
+        # is authorized for the requested method.
+        if (authorized_roles & given_roles):
+            # Carry on
+            return app(scope, receive, send)
+
+        record(logging.INFO,
+               _('User not authorized to %(method)s the %(resource)s '
+                 'resource (project %(project_id)s)'),
+               method=method, resource=resource, project_id=project_id)
+        return _http_forbidden(send)
+
+    return middleware
@@ -0,0 +1,70 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR ONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Loading of rule files shared by the governor and RBAC middleware.
+
+A rules file is either a plain JSON list of rules, or a compiled
+policy artifact (see eom.policy) holding one or more sections of
+rules, keyed by section name, along with the artifact's version.
+"""
+
+from oslo.config import cfg
+import simplejson as json
+
+CONF = cfg.CONF
+
+POLICY_VERSION = 1
+
+
+def get_section(document, section):
+    """Extracts rules from a document that may be a policy artifact.
+
+    :param document: parsed contents of a rules file
+    :param section: either 'rates' or 'acls'
+    :returns: the rules from the artifact, or the document itself
+        if it is a plain rules file
+    :raises: ValueError if the document is an artifact of an
+        unsupported version, or does not contain the section
+    """
+    if not isinstance(document, dict):
+        return document
+
+    if document.get('eom_policy') != POLICY_VERSION:
+        raise ValueError(_('Unsupported policy version: %s') %
+                         document.get('eom_policy'))
+
+    # NOTE(kgriffs): Never fall back to an empty list, since for RBAC
+    # that would mean no rules at all, i.e., failing open.
+    try:
+        return document[section]
+    except KeyError:
+        raise ValueError(_('Policy artifact has no "%s" section') % section)
+
+
+def load(path, section):
+    """Loads rules from a file, which may be a policy artifact.
+
+    :param path: rules file, resolved with CONF.find_file()
+    :param section: section to take from a policy artifact
+    """
+    full_path = CONF.find_file(path)
+    if not full_path:
+        raise cfg.ConfigFilesNotFoundError([path or '<Empty>'])
+
+    with open(full_path) as fd:
+        document = json.load(fd)
+
+    return get_section(document, section)
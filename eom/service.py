@@ -0,0 +1,109 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR ONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Background threads for the middleware, one per process.
+
+Threads do not survive fork(), so a service may be started again in a
+forked child, which then gets a thread of its own. Conversely, a
+service does nothing when stopped in a process that never started it,
+so that (for example) a prefork server's master, which serves no
+requests, doesn't overwrite its workers' snapshots or repeat their
+log lines on the way out.
+"""
+
+import logging
+import os
+import threading
+
+LOG = logging.getLogger(__name__)
+
+
+class Service(object):
+    """Does periodic work on a background thread.
+
+    Subclasses implement tick(), which is called every interval_sec,
+    and once more by stop(). They may also override _prepare() to set
+    up whatever the thread needs, or _run() to replace the loop.
+    """
+
+    def __init__(self, interval_sec):
+        """Initializes attributes.
+
+        :param interval_sec: seconds between calls to tick()
+        """
+        self.interval_sec = interval_sec
+
+        self._stopped = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Starts the thread, unless already running in this process."""
+        with self._lock:
+            pid = os.getpid()
+            if self._pid == pid:
+                return
+
+            self._prepare(forked=self._pid is not None)
+
+            self._pid = pid
+            self._stopped = threading.Event()
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """Stops the thread, then calls tick() one last time.
+
+        Does nothing unless started in this process.
+        """
+        if self._pid != os.getpid():
+            return
+
+        self._stopped.set()
+        self._thread.join()
+
+        self.tick()
+
+    def tick(self):
+        """Does one round of work."""
+        raise NotImplementedError()
+
+    def _prepare(self, forked):
+        """Called by start() before the thread is started.
+
+        :param forked: True if the service was started in a parent
+            process, whose state this process inherited
+        """
+
+    def _wait(self, timeout):
+        """Waits for stop(), returning True if it has been called."""
+
+        # NOTE(kgriffs): Event.wait() always returns None under
+        # Python 2.6, so check the flag separately.
+        self._stopped.wait(timeout)
+        return self._stopped.is_set()
+
+    def _run(self):
+        while not self._wait(self.interval_sec):
+            # NOTE(kgriffs): Never let one error stop the service for
+            # the life of the process.
+            try:
+                self.tick()
+            except Exception:
+                LOG.exception(_('Error in background service %s') %
+                              type(self).__name__)
@@ -0,0 +1,201 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR ONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Persistence of governor counters across restarts.
+
+Counters are periodically written to a compact, memory-mapped file
+from a background thread, and reloaded when the governor starts up so
+that tenants don't get a fresh window every time a worker recycles.
+
+File layout (network byte order)::
+
+    header: magic (4s), number of entries (I)
+    entry:  epoch (q), current count (q), previous count (q),
+            throttle_until (d), key length (H), number of windows (B),
+            key (JSON), then for each window: window_sec (q),
+            window epoch (q), count (q)
+"""
+
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+import simplejson as json
+
+from eom import service
+
+LOG = logging.getLogger(__name__)
+
+MAGIC = 'EOM2'
+HEADER = struct.Struct('!4sI')
+ENTRY = struct.Struct('!qqqdHB')
+WINDOW = struct.Struct('!qqq')
+
+
+def save(cache, path):
+    """Writes the counters in the given cache to a file.
+
+    The file is written to a uniquely-named temporary file in the
+    same directory and then renamed, so readers never see a partial
+    snapshot. Each process should still be given its own path (see
+    Snapshotter), since otherwise the last writer wins.
+    """
+    chunks = []
+    for (limit_key, rate_name), counters in cache.store.items():
+        key = json.dumps([limit_key, rate_name])
+        windows = counters[4:]
+        chunks.append(ENTRY.pack(counters[0], counters[1], counters[2],
+                                 counters[3], len(key), len(windows) / 3))
+        chunks.append(key)
+        chunks.append(''.join(WINDOW.pack(*windows[i:i + 3])
+                              for i in range(0, len(windows), 3)))
+
+    payload = HEADER.pack(MAGIC, len(chunks) / 3) + ''.join(chunks)
+
+    # NOTE(kgriffs): Never share a temporary file between writers;
+    # truncating a file that another process has mapped gets that
+    # process killed with SIGBUS.
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                     prefix='.eom-snapshot-')
+    try:
+        os.fchmod(fd, 0o644)
+        os.ftruncate(fd, len(payload))
+
+        mapped = mmap.mmap(fd, len(payload))
+        mapped[:] = payload
+        mapped.flush()
+        mapped.close()
+        os.close(fd)
+        fd = None
+
+        os.rename(temp_path, path)
+    except Exception:
+        if fd is not None:
+            os.close(fd)
+
+        os.remove(temp_path)
+        raise
+
+
+def load(cache, path, period_sec, now=None):
+    """Loads counters from a snapshot file into the given cache.
+
+    Entries older than two periods (the current and the previous one)
+    are discarded, unless they are still in the penalty box, or one of
+    their long windows is still open.
+
+    :returns: number of entries loaded
+    """
+    if now is None:
+        now = time.time()
+
+    oldest_epoch = int(now / period_sec) - 1
+
+    try:
+        with open(path, 'rb') as fd:
+            mapped = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError) as ex:
+        LOG.warning(_('Could not open snapshot %(path)s: %(ex)s') %
+                    {'path': path, 'ex': ex})
+        return 0
+
+    loaded = 0
+    try:
+        magic, count = HEADER.unpack_from(mapped)
+        if magic != MAGIC:
+            raise ValueError(_('Bad magic number'))
+
+        offset = HEADER.size
+        for i in range(count):
+            (epoch, current_count, previous_count, throttle_until,
+             key_length, num_windows) = ENTRY.unpack_from(mapped, offset)
+
+            offset += ENTRY.size
+            key = mapped[offset:offset + key_length]
+            offset += key_length
+
+            windows = []
+            is_open = False
+            for j in range(num_windows):
+                window = WINDOW.unpack_from(mapped, offset)
+                offset += WINDOW.size
+
+                windows.extend(window)
+                window_sec, window_epoch = window[:2]
+
+                # NOTE(kgriffs): The current count is not folded into
+                # the window until roll-over, so check it as well.
+                current_window = int(now / window_sec)
+                if current_window in (window_epoch,
+                                      int(epoch * period_sec / window_sec)):
+                    is_open = True
+
+            if epoch < oldest_epoch and throttle_until <= now:
+                if not is_open:
+                    continue
+
+            limit_key, rate_name = json.loads(key)
+
+            # JSON turns tuples into lists, which are not hashable
+            if isinstance(limit_key, list):
+                limit_key = tuple(limit_key)
+
+            counters = cache.get_counters(limit_key, rate_name)
+            counters[:] = [epoch, current_count, previous_count,
+                           throttle_until] + windows
+            loaded += 1
+
+    except (struct.error, ValueError) as ex:
+        LOG.warning(_('Snapshot %(path)s is corrupt: %(ex)s') %
+                    {'path': path, 'ex': ex})
+    finally:
+        mapped.close()
+
+    return loaded
+
+
+class Snapshotter(service.Service):
+    """Periodically saves a Cache to a file on a background thread.
+
+    Each process has its own counters, and so must be given its own
+    snapshot file; workers that share one simply overwrite each
+    other's counters, and only the last writer's survive a restart.
+    """
+
+    def __init__(self, cache, path, interval_sec):
+        """Initializes attributes.
+
+        :param cache: eom.governor.Cache to save
+        :param path: file to save snapshots to
+        :param interval_sec: seconds between snapshots
+        """
+        super(Snapshotter, self).__init__(interval_sec)
+
+        self.cache = cache
+        self.path = path
+
+    def tick(self):
+        self.save()
+
+    def save(self):
+        try:
+            save(self.cache, self.path)
+        except (IOError, OSError) as ex:
+            LOG.warning(_('Could not save snapshot %(path)s: %(ex)s') %
+                        {'path': self.path, 'ex': ex})
@@ -0,0 +1,274 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR ONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""End-to-end load benchmark for the RBAC and governor middleware.
+
+Serves rbac.wrap(governor.wrap(app)) from a prefork, threaded wsgiref
+server over loopback, with one worker process per governor node, and
+drives it from several client processes spread across many project
+IDs. For each node_count setting, reports throughput, p50/p99 latency
+and how closely the governor held each project to its soft limit.
+
+Usage::
+
+    python -m tests.bench_middleware --node-counts 1,2,4 --duration 10
+"""
+
+from __future__ import print_function
+
+import httplib
+import multiprocessing
+import optparse
+import os
+import SocketServer
+import time
+from wsgiref import simple_server
+
+from oslo.config import cfg
+
+import eom.governor
+import eom.rbac
+from tests import util
+
+CONF = cfg.CONF
+
+
+class ThreadingWSGIServer(SocketServer.ThreadingMixIn,
+                          simple_server.WSGIServer):
+    daemon_threads = True
+
+
+class QuietHandler(simple_server.WSGIRequestHandler):
+
+    def log_message(self, *args):
+        """Suppresses per-request logging."""
+        pass
+
+
+def _serve(httpd):
+    httpd.serve_forever()
+
+
+def _start_server(port, workers):
+    """Starts a prefork server for the wrapped app.
+
+    The app is created before forking, so each worker ends up with
+    its own copy of the governor's counters, just like a separate
+    node would.
+
+    :returns: list of worker processes
+    """
+    app = eom.rbac.wrap(eom.governor.wrap(util.app))
+    httpd = simple_server.make_server('127.0.0.1', port, app,
+                                      server_class=ThreadingWSGIServer,
+                                      handler_class=QuietHandler)
+
+    processes = []
+    for i in range(workers):
+        process = multiprocessing.Process(target=_serve, args=(httpd,))
+        process.daemon = True
+        process.start()
+        processes.append(process)
+
+    # NOTE(kgriffs): The workers own the listening socket now
+    httpd.server_close()
+
+    return processes
+
+
+def _client(port, path, project_ids, interval, warmup, duration, results):
+    """Sends requests serially until the duration expires.
+
+    Nothing is recorded during the warmup, since the governor only
+    starts limiting once it has a full period of counts to go on.
+
+    :param interval: seconds between requests, or 0 to send as fast
+        as the server allows
+    """
+    headers = {'X-Roles': 'queuing:observer'}
+
+    latencies = []
+    passed = dict((project_id, 0) for project_id in project_ids)
+    statuses = {}
+
+    began = time.time()
+    record_after = began + warmup
+    stop = record_after + duration
+    i = 0
+    while True:
+        project_id = project_ids[i % len(project_ids)]
+        headers['X-Project-ID'] = project_id
+        i += 1
+
+        start = time.time()
+        if start > stop:
+            break
+
+        if interval:
+            delay = began + i * interval - start
+            if delay > 0:
+                time.sleep(delay)
+                start = time.time()
+
+        conn = httplib.HTTPConnection('127.0.0.1', port)
+        conn.request('GET', path, headers=headers)
+        resp = conn.getresponse()
+        resp.read()
+        conn.close()
+
+        if start < record_after:
+            continue
+
+        latencies.append(time.time() - start)
+        statuses[resp.status] = statuses.get(resp.status, 0) + 1
+        if resp.status < 300:
+            passed[project_id] += 1
+
+    results.put((latencies, passed, statuses))
+
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0
+
+    index = int(len(sorted_values) * percent / 100.0)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def run(node_count, options):
+    """Runs the benchmark once for the given node count."""
+    CONF.set_override('node_count', node_count, group='eom:governor')
+
+    group = CONF['eom:governor']
+    period_sec = group['period_sec']
+    warmup = period_sec if options.warmup is None else options.warmup
+
+    # Compare what each project gets through against the total
+    # (cluster-wide) soft limit of the rate that applies.
+    rates = eom.governor._load_rates(group['rates_file'], period_sec, 1)
+    for rate in rates:
+        if rate.applies_to('GET', options.path):
+            break
+
+    port = options.port
+    servers = _start_server(port, node_count)
+
+    # Give the workers a moment to start up
+    time.sleep(0.5)
+
+    project_ids = [str(10000 + i) for i in range(options.projects)]
+    results = multiprocessing.Queue()
+
+    clients = []
+    for i in range(options.clients):
+        # Give each client its own slice of the projects
+        assigned = project_ids[i::options.clients] or project_ids
+
+        interval = 0
+        if options.load_factor:
+            per_project = options.load_factor * rate.soft_limit / period_sec
+            interval = 1.0 / (per_project * len(assigned))
+
+        client = multiprocessing.Process(
+            target=_client,
+            args=(port, options.path, assigned, interval, warmup,
+                  options.duration, results))
+
+        client.start()
+        clients.append(client)
+
+    latencies = []
+    passed = {}
+    statuses = {}
+    for client in clients:
+        client_latencies, client_passed, client_statuses = results.get()
+
+        latencies.extend(client_latencies)
+        for project_id, count in client_passed.items():
+            passed[project_id] = passed.get(project_id, 0) + count
+
+        for status, count in client_statuses.items():
+            statuses[status] = statuses.get(status, 0) + count
+
+    for process in clients + servers:
+        process.terminate()
+        process.join()
+
+    CONF.clear_override('node_count', group='eom:governor')
+
+    num_periods = float(options.duration) / period_sec
+    passed_per_period = sum(passed.values()) / num_periods / len(passed)
+    offered_per_period = len(latencies) / num_periods / len(passed)
+
+    latencies.sort()
+
+    return {
+        'node_count': node_count,
+        'req_per_sec': len(latencies) / float(options.duration),
+        'p50_ms': _percentile(latencies, 50) * 1000,
+        'p99_ms': _percentile(latencies, 99) * 1000,
+        'statuses': statuses,
+        'offered': offered_per_period,
+        'passed': passed_per_period,
+        'soft_limit': rate.soft_limit,
+        'accuracy': passed_per_period / rate.soft_limit,
+    }
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--config-file',
+                      default=os.path.join(os.path.dirname(__file__),
+                                           '..', 'etc', 'eom.conf-sample'))
+    parser.add_option('--node-counts', default='1,2,4',
+                      help='comma-separated node_count settings to run')
+    parser.add_option('--duration', type='int', default=10,
+                      help='seconds to measure each setting')
+    parser.add_option('--warmup', type='float',
+                      help='seconds to run before measuring (default '
+                           'period_sec)')
+    parser.add_option('--clients', type='int', default=8,
+                      help='number of load generator processes')
+    parser.add_option('--projects', type='int', default=16,
+                      help='number of distinct project IDs')
+    parser.add_option('--load-factor', type='float', default=1.5,
+                      help='offered load per project as a multiple of '
+                           'the soft limit, or 0 for no pacing')
+    parser.add_option('--path', default='/v1/queues/fizbit/messages')
+    parser.add_option('--port', type='int', default=8784)
+
+    options, args = parser.parse_args()
+
+    CONF(args=[], default_config_files=[options.config_file])
+
+    for node_count in options.node_counts.split(','):
+        result = run(int(node_count), options)
+
+        statuses = ' '.join('%d=%d' % item
+                            for item in sorted(result['statuses'].items()))
+
+        print('node_count=%(node_count)d '
+              'req/s=%(req_per_sec).1f '
+              'p50=%(p50_ms).2fms '
+              'p99=%(p99_ms).2fms '
+              'offered/period/project=%(offered).1f '
+              'passed/period/project=%(passed).1f '
+              'soft_limit=%(soft_limit)d '
+              'accuracy=%(accuracy).2f' % result, statuses)
+
+
+if __name__ == '__main__':
+    main()
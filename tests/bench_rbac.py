@@ -0,0 +1,115 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR ONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-process benchmark of the WSGI vs. ASGI RBAC middleware.
+
+Calls each middleware directly, without a server, and reports the
+time it adds on top of calling the bare app the same way, so that
+only the cost of the RBAC check itself is measured. Requests are
+allowed, denied, or skipped (the path does not match any rule). The
+ASGI responses are driven to completion by hand, so no event loop
+overhead is included either.
+
+Usage::
+
+    python -m tests.bench_rbac --requests 100000
+"""
+
+from __future__ import print_function
+
+import optparse
+import os
+import time
+
+from oslo.config import cfg
+
+import eom.rbac
+import eom.rbac_asgi
+from tests import test_rbac_asgi
+from tests import util
+
+CONF = cfg.CONF
+
+CASES = [
+    ('allowed', '/v1/queues', 'queuing:observer'),
+    ('denied', '/v1/queues', 'queuing:producer'),
+    ('skipped', '/v1', 'queuing:observer'),
+]
+
+
+def _start_response(status, headers):
+    pass
+
+
+def _send(message):
+    return test_rbac_asgi.Ready()
+
+
+def _bench_wsgi(middleware, env, count):
+    start = time.time()
+    for i in range(count):
+        middleware(env, _start_response)
+
+    return time.time() - start
+
+
+def _bench_asgi(middleware, scope, count):
+    run = test_rbac_asgi.run
+
+    start = time.time()
+    for i in range(count):
+        run(middleware(scope, None, _send))
+
+    return time.time() - start
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--config-file',
+                      default=os.path.join(os.path.dirname(__file__),
+                                           '..', 'etc', 'eom.conf-sample'))
+    parser.add_option('--requests', type='int', default=100000,
+                      help='requests to time per case')
+
+    options, args = parser.parse_args()
+
+    CONF(args=[], default_config_files=[options.config_file])
+
+    wsgi = eom.rbac.wrap(util.app)
+    asgi = eom.rbac_asgi.wrap(test_rbac_asgi.app)
+
+    count = options.requests
+    for name, path, roles in CASES:
+        env = {
+            'PATH_INFO': path,
+            'REQUEST_METHOD': 'GET',
+            'HTTP_X_ROLES': roles,
+            'HTTP_X_PROJECT_ID': '84197',
+        }
+        scope = test_rbac_asgi.to_scope(env)
+
+        wsgi_sec = (_bench_wsgi(wsgi, env, count) -
+                    _bench_wsgi(util.app, env, count))
+        asgi_sec = (_bench_asgi(asgi, scope, count) -
+                    _bench_asgi(test_rbac_asgi.app, scope, count))
+
+        print('%-8s wsgi=+%.2fus asgi=+%.2fus' %
+              (name, wsgi_sec * 1000000 / count,
+               asgi_sec * 1000000 / count))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR ONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import multiprocessing
+import time
+
+import fixtures
+
+import eom.audit
+import eom.rbac
+from tests import util
+
+
+class TestAudit(util.TestCase):
+
+    def setUp(self):
+        super(TestAudit, self).setUp()
+
+        self.logger = self.useFixture(fixtures.FakeLogger(level=logging.INFO))
+        self.audit_log = eom.audit.AuditLog(logging.getLogger('audited'),
+                                            5, 3600)
+        self.addCleanup(self.audit_log.stop)
+
+    def test_aggregate(self):
+        message = 'Denied %(project_id)s'
+        for i in range(3):
+            self.audit_log.record(logging.INFO, message, project_id='84197')
+
+        self.audit_log.record(logging.INFO, message, project_id='5678')
+        self.assertEqual(self.logger.output, '')
+
+        self.audit_log.flush()
+        self.assertEqual(self.logger.output.splitlines(),
+                         ['Denied 84197 (repeated 3 times)', 'Denied 5678'])
+
+    def test_drop(self):
+        for i in range(8):
+            self.audit_log.record(logging.INFO, 'Denied')
+
+        self.assertEqual(self.audit_log.dropped, 3)
+
+        self.audit_log.flush()
+        self.assertIn('Denied (repeated 5 times)', self.logger.output)
+        self.assertIn('dropped 3 events', self.logger.output)
+
+        # Drops are only reported once
+        self.audit_log.flush()
+        self.assertEqual(self.logger.output.count('dropped'), 1)
+
+    def test_level(self):
+        self.audit_log.record(logging.DEBUG, 'Ignored')
+        self.audit_log.record(logging.ERROR, 'Logged')
+        self.audit_log.flush()
+
+        self.assertNotIn('Ignored', self.logger.output)
+        self.assertIn('Logged', self.logger.output)
+
+    def test_stop(self):
+        self.audit_log.start()
+        self.audit_log.record(logging.INFO, 'Denied')
+        self.audit_log.stop()
+
+        self.assertIn('Denied', self.logger.output)
+
+    def test_lazy_start(self):
+        self.assertIsNone(self.audit_log._thread)
+
+        self.audit_log.record(logging.DEBUG, 'Ignored')
+        self.assertIsNone(self.audit_log._thread)
+
+        self.audit_log.record(logging.INFO, 'Denied')
+        self.assertTrue(self.audit_log._thread.is_alive())
+
+    def test_fork(self):
+        self.audit_log.record(logging.INFO, 'Parent')
+        results = multiprocessing.Queue()
+
+        def child():
+            audit_log = self.audit_log
+            audit_log.record(logging.INFO, 'Child')
+
+            results.put((audit_log._thread.is_alive(),
+                         [message for level, message, vars
+                          in audit_log._events]))
+
+        process = multiprocessing.Process(target=child)
+        process.start()
+        process.join()
+
+        # The child got a writer of its own, and only its own events
+        alive, messages = results.get(timeout=5)
+        self.assertTrue(alive)
+        self.assertEqual(messages, ['Child'])
+
+    def test_rbac(self):
+        eom.audit.CONF.set_override('flush_interval_sec', 0.01,
+                                    group='eom:audit')
+        self.addCleanup(eom.audit.CONF.clear_override,
+                        'flush_interval_sec', group='eom:audit')
+
+        rbac = eom.rbac.wrap(util.app)
+
+        env = self.create_env('/v1/queues', 'queuing:producer',
+                              project_id='84197')
+        for i in range(2):
+            rbac(env, self.start_response)
+            self.assertEquals(self.status, '403 Forbidden')
+
+        time.sleep(0.1)
+        self.assertIn('User not authorized to GET the queues resource '
+                      '(project 84197) (repeated 2 times)',
+                      self.logger.output)
@@ -0,0 +1,227 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR ONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import multiprocessing
+import socket
+import time
+
+import fixtures
+
+import eom.gossip
+import eom.governor
+from tests import util
+
+PERIOD_SEC = 5
+INTERVAL_SEC = 0.05
+
+
+def _run_peer(bind, peer, num_requests, done):
+    cache = eom.governor.Cache()
+    gossiper = eom.gossip.Gossiper(cache, PERIOD_SEC, bind, [peer],
+                                   INTERVAL_SEC)
+    gossiper.start()
+
+    calc_sleep = eom.governor._create_calc_sleep(PERIOD_SEC, cache,
+                                                 0.1, 0.99)
+    rate = eom.governor.Rate({'name': 'default', 'soft_limit': 1000,
+                              'hard_limit': 2000}, PERIOD_SEC, 1)
+
+    for i in range(num_requests):
+        calc_sleep('84197', rate)
+
+    # Wait for the final broadcast to go out
+    time.sleep(INTERVAL_SEC * 4)
+    gossiper.stop()
+    done.set()
+
+
+class TestGossip(util.TestCase):
+
+    def setUp(self):
+        super(TestGossip, self).setUp()
+
+        self.cache = eom.governor.Cache()
+        self.gossiper = eom.gossip.Gossiper(self.cache, PERIOD_SEC,
+                                            '127.0.0.1:18791',
+                                            ['127.0.0.1:18792'],
+                                            INTERVAL_SEC)
+        self.addCleanup(self.gossiper.stop)
+
+        self.epoch = int(time.time() / PERIOD_SEC)
+
+    def test_collect_local_deltas(self):
+        counters = self.cache.get_counters('84197', 'default')
+        counters[0:2] = [self.epoch, 3]
+
+        self.assertEqual(self.gossiper.collect(),
+                         [['84197', 'default', self.epoch, 3]])
+        self.assertEqual(self.gossiper.collect(), [])
+
+        counters[1] += 2
+        self.assertEqual(self.gossiper.collect(),
+                         [['84197', 'default', self.epoch, 2]])
+
+    def test_collect_across_epochs(self):
+        now = [self.epoch * PERIOD_SEC]
+        self.useFixture(fixtures.MonkeyPatch('time.time', lambda: now[0]))
+
+        calc_sleep = eom.governor._create_calc_sleep(PERIOD_SEC, self.cache,
+                                                     0.1, 0.99)
+        rate = eom.governor.Rate({'name': 'default', 'soft_limit': 1000,
+                                  'hard_limit': 2000}, PERIOD_SEC, 1)
+
+        for i in range(10):
+            calc_sleep('84197', rate)
+
+        self.gossiper.merge([['84197', 'default', self.epoch, 7]])
+        self.assertEqual(self.gossiper.collect(),
+                         [['84197', 'default', self.epoch, 10]])
+
+        # Counted after the last broadcast of the epoch
+        for i in range(5):
+            calc_sleep('84197', rate)
+
+        # Not yet rolled over
+        now[0] += PERIOD_SEC
+        self.assertEqual(self.gossiper.collect(),
+                         [['84197', 'default', self.epoch, 5]])
+
+        calc_sleep('84197', rate)
+        self.gossiper.merge([['84197', 'default', self.epoch, 2]])
+        self.assertEqual(self.gossiper.collect(),
+                         [['84197', 'default', self.epoch + 1, 1]])
+
+        # Rolled over before anything was sent
+        for i in range(4):
+            calc_sleep('84197', rate)
+
+        now[0] += PERIOD_SEC
+        calc_sleep('84197', rate)
+        self.assertEqual(self.gossiper.collect(),
+                         [['84197', 'default', self.epoch + 1, 4],
+                          ['84197', 'default', self.epoch + 2, 1]])
+
+        self.assertEqual(self.gossiper.collect(), [])
+
+    def test_merge_is_not_echoed(self):
+        self.gossiper.merge([[['84197', 'kgriffs'], 'bulk', self.epoch, 7]])
+
+        counters = self.cache.get_counters(('84197', 'kgriffs'), 'bulk')
+        self.assertEqual(counters[0:3], [self.epoch, 7, 0])
+        self.assertEqual(self.gossiper.collect(), [])
+
+        counters[1] += 1
+        self.assertEqual(self.gossiper.collect(),
+                         [[('84197', 'kgriffs'), 'bulk', self.epoch, 1]])
+
+    def test_merge_epochs(self):
+        counters = self.cache.get_counters('84197', 'default')
+        counters[0:3] = [self.epoch - 1, 10, 4]
+
+        # New epoch rolls the counters over
+        self.gossiper.merge([['84197', 'default', self.epoch, 5]])
+        self.assertEqual(counters[0:3], [self.epoch, 5, 10])
+
+        # Late arrivals count toward the previous epoch
+        self.gossiper.merge([['84197', 'default', self.epoch - 1, 2]])
+        self.assertEqual(counters[0:3], [self.epoch, 5, 12])
+
+        # Anything older is dropped
+        self.gossiper.merge([['84197', 'default', self.epoch - 2, 2]])
+        self.assertEqual(counters[0:3], [self.epoch, 5, 12])
+
+    def test_unknown_host(self):
+        self.gossiper.receive('[["84197", "default", %d, 1]]' % self.epoch,
+                              ('10.0.0.99', 18792))
+        self.gossiper.receive('not json', ('127.0.0.1', 18792))
+        self.assertEqual(self.cache.store, {})
+
+    def test_malformed_updates(self):
+        address = ('127.0.0.1', 18792)
+        for datagram in ('[1]', '{"a": 1}', '[[1, 2, 3, 4]]',
+                         '[["84197", "default", "x", 1]]',
+                         '[[["84197", [1]], "default", %d, 1]]' % self.epoch,
+                         '[["84197", "default", %d, -5]]' % self.epoch):
+            self.gossiper.receive(datagram, address)
+
+        self.assertEqual(self.cache.store, {})
+
+        # Valid updates in the same datagram still count
+        self.gossiper.receive('[[1], ["84197", "default", %d, 2]]' %
+                              self.epoch, address)
+        counters = self.cache.get_counters('84197', 'default')
+        self.assertEqual(counters[1], 2)
+
+    def test_survives_errors(self):
+        def fail(datagram, address):
+            raise RuntimeError()
+
+        self.gossiper.receive = fail
+        self.gossiper.start()
+
+        peer = eom.gossip.Gossiper(eom.governor.Cache(), PERIOD_SEC,
+                                   '127.0.0.1:18792', ['127.0.0.1:18791'],
+                                   INTERVAL_SEC)
+        self.addCleanup(peer.stop)
+        peer.start()
+        peer._sock.sendto('[]', ('127.0.0.1', 18791))
+
+        time.sleep(INTERVAL_SEC * 2)
+        self.assertTrue(self.gossiper._thread.is_alive())
+
+    def test_bind_in_use(self):
+        self.gossiper.start()
+
+        gossiper = eom.gossip.Gossiper(eom.governor.Cache(), PERIOD_SEC,
+                                       '127.0.0.1:18791', [], INTERVAL_SEC)
+        self.assertRaises(socket.error, gossiper.start)
+
+    def test_fork(self):
+        self.gossiper.start()
+        results = multiprocessing.Queue()
+
+        def child():
+            # NOTE(kgriffs): The parent still holds its own address
+            self.gossiper.bind = '127.0.0.1:18793'
+            self.gossiper.start()
+
+            results.put((self.gossiper._thread.is_alive(),
+                         self.gossiper._sock.getsockname()[1]))
+
+        process = multiprocessing.Process(target=child)
+        process.start()
+        process.join()
+
+        self.assertEqual(results.get(timeout=5), (True, 18793))
+
+    def test_peer_process(self):
+        self.gossiper.start()
+
+        done = multiprocessing.Event()
+        peer = multiprocessing.Process(
+            target=_run_peer,
+            args=('127.0.0.1:18792', '127.0.0.1:18791', 50, done))
+
+        peer.start()
+        done.wait(5)
+        peer.join()
+
+        # Give our side a moment to process the final datagram
+        time.sleep(INTERVAL_SEC * 2)
+
+        counters = self.cache.get_counters('84197', 'default')
+        self.assertIn(counters[0], (self.epoch, self.epoch + 1))
+        self.assertEqual(counters[1] + counters[2], 50)
@@ -16,13 +16,20 @@
 
 import io
 import logging
+import math
 import multiprocessing
+import os
+import random
 import sys
+import tempfile
 import time
 from wsgiref import simple_server
 
+import eom.audit
 import eom.governor
+import fixtures
 import requests
+import simplejson as json
 
 from tests import util
 
@@ -45,7 +52,8 @@ class TestGovernor(util.TestCase):
         self.hard_limit = self.test_rate.hard_limit
         self.test_url = '/v1/queues/fizbit/messages'
 
-        self.default_rate = rates[1]
+        self.health_rate = rates[1]
+        self.default_rate = rates[-1]
 
     def _quantum_leap(self):
         # Wait until the next time quantum
@@ -65,6 +73,263 @@ class TestGovernor(util.TestCase):
         self.governor(env, self.start_response)
         self.assertEquals(self.status, '204 No Content')
 
+    def test_limit_headers(self):
+        env = self.create_env(self.test_url, project_id='84197')
+        self.governor(env, self.start_response)
+        self.governor(env, self.start_response)
+
+        headers = dict(self.headers)
+        self.assertEqual(headers['X-RateLimit-Limit'],
+                         str(self.soft_limit))
+        self.assertEqual(headers['X-RateLimit-Remaining'],
+                         str(self.soft_limit - 2))
+
+        reset = int(headers['X-RateLimit-Reset'])
+        self.assertEqual(reset % self.period_sec, 0)
+        self.assertAlmostEqual(reset, time.time(), delta=self.period_sec)
+
+    def test_sleep_logged_in_background(self):
+        logger = self.useFixture(fixtures.FakeLogger(level=logging.DEBUG))
+        self.useFixture(fixtures.MonkeyPatch('time.sleep', lambda sec: None))
+
+        now = [time.time()]
+        self.useFixture(fixtures.MonkeyPatch('time.time', lambda: now[0]))
+
+        audit_logs = []
+        create_audit_log = eom.audit.create_audit_log
+
+        def capture(logger):
+            audit_log = create_audit_log(logger)
+            audit_logs.append(audit_log)
+            return audit_log
+
+        self.useFixture(fixtures.MonkeyPatch('eom.audit.create_audit_log',
+                                             capture))
+
+        eom.audit.CONF.set_override('flush_interval_sec', 3600,
+                                    group='eom:audit')
+        self.addCleanup(eom.audit.CONF.clear_override,
+                        'flush_interval_sec', group='eom:audit')
+
+        governor = self._wrap_rates(
+            [{'name': 'default', 'soft_limit': 2, 'hard_limit': 100}],
+            max_sleep_sec=3600, limit_headers=False)
+
+        env = self.create_env('/v1', project_id='84197')
+        for i in range(10):
+            governor(env, self.start_response)
+
+        # Throttle in the next period, based on the one before
+        now[0] += self.period_sec
+        for i in range(3):
+            governor(env, self.start_response)
+            self.assertEqual(self.status, '204 No Content')
+
+        self.assertNotIn('Sleeping', logger.output)
+
+        audit_logs[0].flush()
+        self.assertIn('Sleeping to limit 84197 to 1 according to rate '
+                      'rule "default" (repeated 3 times)', logger.output)
+
+    def test_limit_headers_rejected(self):
+        # In the penalty box, with an epoch that is long gone
+        now = time.time()
+        counters = [int(now / self.period_sec) - 10, 1, 500, now + 30.5]
+
+        headers = dict(eom.governor._limit_headers(
+            self.test_rate, counters, self.period_sec, rejected=True))
+
+        self.assertEqual(headers['X-RateLimit-Remaining'], '0')
+        self.assertEqual(headers['X-RateLimit-Reset'],
+                         str(int(math.ceil(now + 30.5))))
+
+    def test_no_limit_headers(self):
+        governor = self._wrap_rates([self._hierarchical_doc()],
+                                    limit_headers=False)
+
+        env = self.create_env('/v1', project_id='84197')
+        env['HTTP_X_USER_ID'] = 'kgriffs'
+        governor(env, self.start_response)
+        self.assertEqual(self.headers, [])
+
+    def test_retry_after(self):
+        self.assertEqual(eom.governor._retry_after(0.01),
+                         ('Retry-After', '1'))
+        self.assertEqual(eom.governor._retry_after(2.5),
+                         ('Retry-After', '3'))
+        self.assertEqual(eom.governor._retry_after(3600),
+                         ('Retry-After', '3600'))
+
+    def test_anonymous(self):
+        env = self.create_env('/v1/health')
+        self.governor(env, self.start_response)
+        self.assertEquals(self.status, '204 No Content')
+
+    def test_key_extractors(self):
+        env = self.create_env('/v1', project_id='84197')
+        env['HTTP_X_USER_ID'] = 'kgriffs'
+
+        self.assertEqual(self.health_rate.get_key(env), '')
+        self.assertEqual(self.default_rate.get_key(env), '84197')
+
+        document = {
+            'name': 'per_user',
+            'keys': ['HTTP_X_PROJECT_ID', 'HTTP_X_USER_ID'],
+            'soft_limit': 10,
+            'hard_limit': 20,
+        }
+
+        rate = eom.governor.Rate(document, self.period_sec, 1)
+        self.assertEqual(rate.get_key(env), ('84197', 'kgriffs'))
+
+        del env['HTTP_X_USER_ID']
+        self.assertRaises(KeyError, rate.get_key, env)
+
+    def test_hierarchical_limits(self):
+        rate = eom.governor.Rate(self._hierarchical_doc(),
+                                 self.period_sec, 1)
+
+        project_limit, user_limit = rate.limits
+        self.assertIs(project_limit, rate)
+        self.assertEqual(user_limit.name,
+                         'bulk[HTTP_X_PROJECT_ID,HTTP_X_USER_ID]')
+        self.assertEqual(user_limit.hard_limit, 10)
+
+        cache = eom.governor.Cache()
+        calc_sleep = eom.governor._create_calc_sleep(self.period_sec, cache,
+                                                     0.1, 0.99)
+
+        self._overflow(cache, ('84197', 'kgriffs'), user_limit)
+        self.assertRaises(eom.governor.HardLimitError,
+                          calc_sleep, ('84197', 'kgriffs'), user_limit)
+
+        # Other users in the same project are unaffected
+        self.assertEqual(calc_sleep(('84197', 'flaper87'), user_limit), 0)
+        self.assertEqual(calc_sleep('84197', project_limit), 0)
+
+    def test_adaptive_first_sample(self):
+        rate, adapt = self._create_adaptive()
+
+        # The first sample seeds the average, without adjusting
+        # the soft limit on its own
+        adapt(rate, time.time() - 1)
+        self.assertTrue(rate.latency_ewma >= 1)
+        self.assertEqual(rate.soft_limit, 100)
+        self.assertEqual(rate.target, 100.0 / self.period_sec)
+
+        rate, adapt = self._create_adaptive()
+
+        adapt(rate, time.time())
+        self.assertEqual(rate.soft_limit, 100)
+
+    def test_adaptive_decrease(self):
+        rate, adapt = self._create_adaptive()
+        adapt(rate, time.time() - 1)
+
+        rate.adapt_epoch = 0
+        adapt(rate, time.time() - 1)
+        self.assertEqual(rate.soft_limit, 50)
+        self.assertEqual(rate.target, 50.0 / self.period_sec)
+
+        # Adjustments only happen once per period
+        adapt(rate, time.time() - 1)
+        self.assertEqual(rate.soft_limit, 50)
+
+        # Never go below the configured minimum
+        for i in range(5):
+            rate.adapt_epoch = 0
+            adapt(rate, time.time() - 1)
+
+        self.assertEqual(rate.soft_limit, 20)
+
+    def test_adaptive_increase(self):
+        rate, adapt = self._create_adaptive()
+        adapt(rate, time.time())
+
+        rate.adapt_epoch = 0
+        adapt(rate, time.time())
+        self.assertEqual(rate.soft_limit, 115)
+
+        # Never go above the configured maximum
+        for i in range(5):
+            rate.adapt_epoch = 0
+            adapt(rate, time.time())
+
+        self.assertEqual(rate.soft_limit, 150)
+
+    def test_priority_shedding(self):
+        rate_docs = [
+            {
+                'name': 'bulk',
+                'route': '/v1/bulk',
+                'priority': 'low',
+                'soft_limit': 100,
+                'hard_limit': 200,
+            },
+            {
+                'name': 'health',
+                'route': '/v1/health',
+                'keys': [],
+                'priority': 'critical',
+                'soft_limit': 100,
+                'hard_limit': 200,
+            },
+        ]
+
+        nested = []
+
+        def app(env, start_response):
+            # NOTE(kgriffs): Issue nested requests while this one is
+            # still in flight to simulate a busy node.
+            if not nested:
+                for path in ('/v1/bulk', '/v1/health'):
+                    nested_env = self.create_env(path, project_id='84197')
+                    governor(nested_env, self.start_response)
+                    nested.append(self.status)
+
+            return util.app(env, start_response)
+
+        governor = self._wrap_rates(rate_docs, app, max_inflight=2)
+
+        env = self.create_env('/v1/health')
+        governor(env, self.start_response)
+        self.assertEquals(self.status, '204 No Content')
+        self.assertEquals(nested, ['429 Too Many Requests', '204 No Content'])
+        self.assertIn(('X-RateLimit-Limit', str(100 / self.node_count)),
+                      self.headers)
+
+        # Once the node drains, low-priority requests pass again
+        env = self.create_env('/v1/bulk', project_id='84197')
+        governor(env, self.start_response)
+        self.assertEquals(self.status, '204 No Content')
+
+    def test_hierarchical_missing_key(self):
+        governor = self._wrap_rates([self._hierarchical_doc()])
+
+        env = self.create_env('/v1', project_id='84197')
+        governor(env, self.start_response)
+        self.assertEquals(self.status, '400 Bad Request')
+
+        env['HTTP_X_USER_ID'] = 'kgriffs'
+        governor(env, self.start_response)
+        self.assertEquals(self.status, '204 No Content')
+
+    def test_hierarchical_missing_key_not_counted(self):
+        document = self._hierarchical_doc()
+        document['soft_limit'] = 4 * self.node_count
+        document['limits'][0]['soft_limit'] = 100 * self.node_count
+        governor = self._wrap_rates([document])
+
+        env = self.create_env('/v1', project_id='84197')
+        for i in range(3):
+            governor(env, self.start_response)
+            self.assertEquals(self.status, '400 Bad Request')
+
+        env['HTTP_X_USER_ID'] = 'kgriffs'
+        governor(env, self.start_response)
+        self.assertEquals(self.status, '204 No Content')
+        self.assertIn(('X-RateLimit-Remaining', '3'), self.headers)
+
     def test_soft_limit(self):
         self._test_limit(self.soft_limit, 204)
 
@@ -80,10 +345,411 @@ class TestGovernor(util.TestCase):
     def test_hard_limit_burst(self):
         self._test_limit(self.hard_limit, 429, burst=True)
 
+    def test_cache_throttle(self):
+        cache = eom.governor.Cache()
+        self.assertFalse(cache.is_throttled('84197', 'default', 100))
+
+        cache.set_throttle('84197', 'default', 10, 100)
+        self.assertTrue(cache.is_throttled('84197', 'default', 109.9))
+        self.assertFalse(cache.is_throttled('84197', 'default', 110))
+        self.assertFalse(cache.is_throttled('5678', 'default', 105))
+        self.assertFalse(cache.is_throttled('84197', 'other', 105))
+
+    def test_penalty_box(self):
+        self._test_penalty(30, eom.governor.HardLimitError)
+
+    def test_no_penalty_box(self):
+        self._test_penalty(0, None)
+
+    def test_counters_per_rate(self):
+        cache = eom.governor.Cache()
+        calc_sleep = eom.governor._create_calc_sleep(self.period_sec, cache,
+                                                     0.1, 0.99)
+
+        project_id = '84197'
+        self._overflow(cache, project_id, self.test_rate)
+
+        self.assertRaises(eom.governor.HardLimitError,
+                          calc_sleep, project_id, self.test_rate)
+        self.assertEqual(calc_sleep(project_id, self.default_rate), 0)
+        self.assertEqual(calc_sleep('5678', self.test_rate), 0)
+
+        counters = cache.get_counters(project_id, self.default_rate.name)
+        self.assertEqual(counters[eom.governor.CURRENT_COUNT], 1)
+
+    def test_window_quota(self):
+        cache = eom.governor.Cache()
+        calc_sleep = eom.governor._create_calc_sleep(self.period_sec, cache,
+                                                     0.1, 0.99)
+
+        rate = self._create_windowed()
+        for i in range(10):
+            calc_sleep('84197', rate)
+
+        self.assertRaises(eom.governor.HardLimitError,
+                          calc_sleep, '84197', rate)
+
+        # Rejected until the window is over
+        counters = cache.get_counters('84197', rate.name)
+        window_sec = rate.windows[0][1]
+        self.assertEqual(counters[eom.governor.THROTTLE_UNTIL],
+                         (int(time.time() / window_sec) + 1) * window_sec)
+
+    def test_window_roll_over(self):
+        cache = eom.governor.Cache()
+        calc_sleep = eom.governor._create_calc_sleep(self.period_sec, cache,
+                                                     0.1, 0.99)
+
+        rate = self._create_windowed()
+        offset, window_sec, window_limit = rate.windows[0]
+
+        # Requests from past epochs count against the window
+        epoch = int(time.time() / self.period_sec)
+        counters = cache.get_counters('84197', rate.name)
+        counters[:] = [epoch - 5, 8, 0, 0, window_sec,
+                       int(time.time() / window_sec), 0]
+
+        calc_sleep('84197', rate)
+        self.assertEqual(counters[offset + 2], 8)
+        self.assertEqual(counters[eom.governor.PREVIOUS_COUNT], 0)
+
+        calc_sleep('84197', rate)
+        self.assertRaises(eom.governor.HardLimitError,
+                          calc_sleep, '84197', rate)
+
+        # Counts from an old window are discarded
+        cache.fold(counters, (counters[offset + 1] + 1) * window_sec, 2)
+        self.assertEqual(counters[offset + 2], 2)
+
+    def test_window_length_changed(self):
+        rate = eom.governor.Rate({
+            'name': 'quota', 'soft_limit': 1000, 'hard_limit': 2000,
+            'windows': [{'period_sec': 3600, 'limit': 50}],
+        }, self.period_sec, 1)
+
+        # NOTE(kgriffs): Stay within a single day (and hour) throughout
+        start = 86400 * 20000
+        clock = [start]
+        self.useFixture(fixtures.MonkeyPatch('time.time', lambda: clock[0]))
+
+        for bulk in (False, True):
+            # Counters restored from a snapshot taken back when the
+            # window was a day long.
+            cache = eom.governor.Cache()
+            cache.get_counters('84197', rate.name)[:] = [
+                0, 0, 0, 0, 86400, int(start / 86400), 0]
+
+            calc_sleep = eom.governor._create_calc_sleep(
+                self.period_sec, cache, 0.1, 0.99)
+            calc_sleep_bulk = eom.governor._create_calc_sleep_bulk(
+                self.period_sec, cache, 0.99, float('inf'), [rate])
+
+            passed = 0
+            for i in range(10):
+                clock[0] = start + i * self.period_sec
+                if bulk:
+                    decisions = calc_sleep_bulk(['84197'] * 20,
+                                                [rate.name] * 20)
+                    passed += decisions.tolist().count(0)
+                    continue
+
+                for j in range(20):
+                    try:
+                        calc_sleep('84197', rate)
+                        passed += 1
+                    except eom.governor.HardLimitError:
+                        pass
+
+            self.assertEqual(passed, 50)
+
+    def test_window_not_multiple(self):
+        document = {
+            'name': 'daily',
+            'soft_limit': 100,
+            'hard_limit': 200,
+            'windows': [{'period_sec': self.period_sec + 1, 'limit': 10}],
+        }
+
+        self.assertRaises(ValueError, eom.governor.Rate,
+                          document, self.period_sec, 1)
+
+    def test_bulk_matches_calc_sleep(self):
+        documents = [
+            {'name': 'plain', 'soft_limit': 4, 'hard_limit': 8},
+            {'name': 'penalty', 'soft_limit': 4, 'hard_limit': 8,
+             'penalty_sec': 30},
+            {'name': 'quota', 'soft_limit': 4, 'hard_limit': 8,
+             'windows': [{'period_sec': self.period_sec * 10 ** 9,
+                          'limit': 12},
+                         {'period_sec': self.period_sec * 10 ** 8,
+                          'limit': 10}]},
+            {'name': 'nested', 'soft_limit': 6, 'hard_limit': 10,
+             'limits': [{'soft_limit': 3, 'hard_limit': 5}]},
+            {'name': 'shared_quota', 'keys': [], 'soft_limit': 4,
+             'hard_limit': 8,
+             'windows': [{'period_sec': self.period_sec * 10 ** 9,
+                          'limit': 12}]},
+            {'name': 'shared_penalty', 'keys': [], 'soft_limit': 4,
+             'hard_limit': 8, 'penalty_sec': 30},
+        ]
+
+        now = time.time()
+        self.useFixture(fixtures.MonkeyPatch('time.time', lambda: now))
+        epoch = int(now / self.period_sec)
+
+        rng = random.Random(84197)
+        for trial in range(200):
+            rates = [eom.governor.Rate(document, self.period_sec, 1)
+                     for document in documents]
+
+            caches = (eom.governor.Cache(), eom.governor.Cache())
+            for rate in rates:
+                for limit in rate.limits:
+                    for project_id in ('a', 'b', 'c'):
+                        limit_key = limit.get_key(
+                            {'HTTP_X_PROJECT_ID': project_id})
+                        counters = [rng.choice((epoch - 1, epoch)),
+                                    rng.randint(0, 10), rng.randint(0, 10),
+                                    rng.choice((0, now + 5))]
+                        for offset, window_sec, window_limit in limit.windows:
+                            counters.extend((window_sec,
+                                             int(now / window_sec),
+                                             rng.randint(0, 10)))
+
+                        for cache in caches:
+                            cache.get_counters(limit_key,
+                                               limit.name)[:] = counters[:]
+
+            count = rng.randint(1, 30)
+            project_ids = [rng.choice('abc') for i in range(count)]
+            batch_rates = [rng.choice(rates) for i in range(count)]
+
+            calc_sleep = eom.governor._create_calc_sleep(
+                self.period_sec, caches[0], 0.1, 0.99)
+
+            expected = []
+            for project_id, rate in zip(project_ids, batch_rates):
+                env = {'HTTP_X_PROJECT_ID': project_id}
+                sleep_sec = 0
+                for limit in rate.limits:
+                    try:
+                        sleep_sec = max(sleep_sec,
+                                        calc_sleep(limit.get_key(env), limit))
+                    except eom.governor.HardLimitError:
+                        sleep_sec = eom.governor.REJECT
+                        break
+
+                expected.append(sleep_sec)
+
+            calc_sleep_bulk = eom.governor._create_calc_sleep_bulk(
+                self.period_sec, caches[1], 0.99, float('inf'), rates)
+            decisions = calc_sleep_bulk(project_ids,
+                                        [rate.name for rate in batch_rates])
+
+            self.assertEqual(list(decisions), expected)
+            self.assertEqual(caches[1].store, caches[0].store)
+
+    def test_accountant(self):
+        cache = eom.governor.Cache()
+        account = eom.governor.create_accountant(cache)
+
+        now = time.time()
+        hard_limit = self.default_rate.hard_limit
+        decisions = account(['84197'] * (hard_limit + 1) + ['5678'],
+                            ['default'] * (hard_limit + 2), now)
+
+        self.assertEqual(list(decisions), [0] * (hard_limit + 2))
+
+        # Next period, throttle 84197 but not 5678
+        decisions = account(['84197', '5678', 'x'],
+                            ['default', 'default', 'health'],
+                            now + self.period_sec)
+
+        self.assertEqual(decisions[0], eom.governor.REJECT)
+        self.assertEqual(decisions[1:].tolist(), [0, 0])
+
+        # Keyless rates share a single set of counters
+        counters = cache.get_counters('', self.health_rate.name)
+        self.assertEqual(counters[eom.governor.CURRENT_COUNT], 1)
+
+        # An unknown rate name fails the batch before anything is counted
+        counters = cache.get_counters('5678', self.default_rate.name)
+        count = counters[eom.governor.CURRENT_COUNT]
+        self.assertRaises(KeyError, account, ['5678', '5678'],
+                          ['default', 'unknown'], now + self.period_sec)
+        self.assertEqual(counters[eom.governor.CURRENT_COUNT], count)
+
+        # So do lists of different lengths
+        self.assertRaises(ValueError, account, ['5678', '5678', '5678'],
+                          ['default'], now + self.period_sec)
+        self.assertEqual(counters[eom.governor.CURRENT_COUNT], count)
+
+    def test_accountant_max_sleep(self):
+        rate = self.default_rate
+        now = time.time()
+
+        decisions = []
+        for max_sleep_sec in (float('inf'), 0):
+            cache = eom.governor.Cache()
+            counters = cache.get_counters('84197', rate.name)
+            counters[:3] = [int(now / self.period_sec), 0, rate.hard_limit]
+
+            calc_sleep_bulk = eom.governor._create_calc_sleep_bulk(
+                self.period_sec, cache, 0.99, max_sleep_sec, [rate])
+            decisions.append(calc_sleep_bulk(['84197'], [rate.name], now)[0])
+
+        self.assertTrue(0 < decisions[0] < eom.governor.REJECT)
+        self.assertEqual(decisions[1], eom.governor.REJECT)
+
+    def test_accountant_hierarchical(self):
+        self._override_rates([self._hierarchical_doc()])
+
+        # NOTE(kgriffs): The nested limit needs a user ID, which is
+        # never available, so the rate is refused up front.
+        self.assertRaises(ValueError, eom.governor.create_accountant)
+
+    def test_start_per_process(self):
+        class Service(object):
+            def __init__(self, fail=False):
+                self.pids = []
+                self.fail = fail
+
+            def start(self):
+                self.pids.append(os.getpid())
+                if self.fail:
+                    raise RuntimeError()
+
+        services = [Service(fail=True), Service()]
+        app = eom.governor._start_per_process(util.app, services)
+
+        # Nothing starts until the first request
+        self.assertEqual(services[1].pids, [])
+
+        env = self.create_env('/v1', project_id='84197')
+        for i in range(2):
+            app(env, self.start_response)
+            self.assertEquals(self.status, '204 No Content')
+
+        # A failing service doesn't keep the others from starting
+        self.assertEqual(services[1].pids, [os.getpid()])
+
+        results = multiprocessing.Queue()
+
+        def child():
+            app(env, self.start_response)
+            results.put(services[1].pids)
+
+        process = multiprocessing.Process(target=child)
+        process.start()
+        process.join()
+
+        self.assertEqual(results.get(timeout=5),
+                         [os.getpid(), process.pid])
+
     #----------------------------------------------------------------------
     # Helpers
     #----------------------------------------------------------------------
 
+    def _create_adaptive(self):
+        document = {
+            'name': 'adaptive',
+            'soft_limit': 100,
+            'hard_limit': 200,
+            'latency_sec': 0.1,
+            'min_soft_limit': 20,
+            'max_soft_limit': 150,
+        }
+
+        rate = eom.governor.Rate(document, self.period_sec, 1)
+        adapt = eom.governor._create_adapt(self.period_sec, 0.5, 0.1, 0.5)
+
+        return rate, adapt
+
+    def _create_windowed(self):
+        # NOTE(kgriffs): Use a huge window so that the test can't
+        # straddle two of them.
+        document = {
+            'name': 'daily',
+            'soft_limit': 100,
+            'hard_limit': 200,
+            'windows': [
+                {'period_sec': self.period_sec * 10 ** 9, 'limit': 20},
+            ],
+        }
+
+        return eom.governor.Rate(document, self.period_sec, 2)
+
+    def _hierarchical_doc(self):
+        return {
+            'name': 'bulk',
+            'soft_limit': 50,
+            'hard_limit': 100,
+            'limits': [
+                {
+                    'keys': ['HTTP_X_PROJECT_ID', 'HTTP_X_USER_ID'],
+                    'soft_limit': 5,
+                    'hard_limit': 10,
+                },
+            ],
+        }
+
+    def _override_rates(self, rate_docs, **overrides):
+        fd, path = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(fd, 'w') as rates_file:
+            json.dump(rate_docs, rates_file)
+
+        self.addCleanup(os.remove, path)
+
+        overrides['rates_file'] = path
+        for name, value in overrides.items():
+            eom.governor.CONF.set_override(name, value,
+                                           group='eom:governor')
+            self.addCleanup(eom.governor.CONF.clear_override,
+                            name, group='eom:governor')
+
+    def _wrap_rates(self, rate_docs, app=util.app, **overrides):
+        self._override_rates(rate_docs, **overrides)
+        return eom.governor.wrap(app)
+
+    def _overflow(self, cache, limit_key, rate):
+        # NOTE(kgriffs): Fill both counters so that the project stays
+        # over the hard limit even if we happen to cross into the
+        # next epoch while the test is running.
+        counters = cache.get_counters(limit_key, rate.name)
+        counters[eom.governor.EPOCH] = int(time.time() / self.period_sec)
+        counters[eom.governor.CURRENT_COUNT] = rate.hard_limit + 1
+        counters[eom.governor.PREVIOUS_COUNT] = rate.hard_limit + 1
+
+    def _test_penalty(self, penalty_sec, expected_error):
+        document = {
+            'name': 'penalized',
+            'soft_limit': 10,
+            'hard_limit': 20,
+            'penalty_sec': penalty_sec,
+        }
+
+        rate = eom.governor.Rate(document, self.period_sec, 1)
+        cache = eom.governor.Cache()
+        calc_sleep = eom.governor._create_calc_sleep(self.period_sec, cache,
+                                                     0.1, 0.99)
+
+        project_id = '84197'
+        self._overflow(cache, project_id, rate)
+
+        self.assertRaises(eom.governor.HardLimitError,
+                          calc_sleep, project_id, rate)
+
+        # Even with clean counters, the project should stay
+        # rejected while it sits in the penalty box.
+        counters = cache.get_counters(project_id, rate.name)
+        counters[eom.governor.CURRENT_COUNT] = 0
+        counters[eom.governor.PREVIOUS_COUNT] = 0
+
+        if expected_error is None:
+            self.assertEqual(calc_sleep(project_id, rate), 0)
+        else:
+            self.assertRaises(expected_error, calc_sleep, project_id, rate)
+
     def _test_limit(self, limit, expected_status,
                     http_method='GET', burst=False):
 
@@ -142,6 +808,11 @@ class TestGovernor(util.TestCase):
         while time.time() < stop_N:
             resp = request(url, headers={'X-Project-ID': 1234})
             self.assertEquals(resp.status_code, expected_status)
+            self.assertIn('X-RateLimit-Reset', resp.headers)
+
+            if expected_status == 429:
+                self.assertIn('Retry-After', resp.headers)
+                self.assertEqual(resp.headers['X-RateLimit-Remaining'], '0')
 
             num_requests += 1
 
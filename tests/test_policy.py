@@ -0,0 +1,207 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR ONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+
+import fixtures
+import simplejson as json
+
+import eom.governor
+import eom.policy
+import eom.rbac
+import eom.rules
+from tests import util
+
+
+class TestPolicy(util.TestCase):
+
+    def setUp(self):
+        super(TestPolicy, self).setUp()
+
+        self.rates_path = self.conf_path('governor.json-sample')
+        self.acls_path = self.conf_path('rbac.json-sample')
+
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        self.output_path = os.path.join(temp_dir, 'eom.policy')
+
+    def test_samples_are_clean(self):
+        args = ['--rates', self.rates_path, '--acls', self.acls_path,
+                '--strict']
+        self.assertEqual(eom.policy.main(args), 0)
+
+    def test_backtracking_risk(self):
+        self.assertTrue(eom.policy.backtracking_risk('/v1/(a+)+'))
+        self.assertTrue(eom.policy.backtracking_risk('/v1/(?:[^/]*/?)*'))
+        self.assertFalse(eom.policy.backtracking_risk('/v1/queues(/[^/]+)?'))
+        self.assertFalse(eom.policy.backtracking_risk('/v1/(ab){1,3}'))
+
+    def test_shadowed_rates(self):
+        documents = [
+            {'name': 'messages', 'route': '/v1/queues/[^/]+/messages',
+             'soft_limit': 10, 'hard_limit': 20},
+            {'name': 'catch_all', 'soft_limit': 10, 'hard_limit': 20},
+            {'name': 'fizbit', 'route': '/v1/queues/fizbit/messages',
+             'methods': ['GET'], 'soft_limit': 10, 'hard_limit': 20},
+            {'name': 'health', 'route': '/v1/health',
+             'soft_limit': 10, 'hard_limit': 20},
+        ]
+
+        problems = eom.policy.lint_rates('governor.json', documents)
+        shadowed = [name for level, source, name, message in problems]
+        self.assertEqual(shadowed, ['fizbit', 'health'])
+
+    def test_methods_narrow_shadowing(self):
+        documents = [
+            {'name': 'get', 'methods': ['GET'],
+             'soft_limit': 10, 'hard_limit': 20},
+            {'name': 'post', 'methods': ['POST'],
+             'soft_limit': 10, 'hard_limit': 20},
+            {'name': 'any', 'soft_limit': 10, 'hard_limit': 20},
+        ]
+
+        self.assertEqual(eom.policy.lint_rates('governor.json', documents),
+                         [])
+
+    def test_invalid_rates(self):
+        documents = [
+            {'name': 'missing_limits'},
+            {'name': 'bad_route', 'route': '(',
+             'soft_limit': 10, 'hard_limit': 20},
+            {'name': 'backwards', 'soft_limit': 30, 'hard_limit': 20},
+            {'name': 'backwards', 'methods': [],
+             'soft_limit': 10, 'hard_limit': 20},
+        ]
+
+        problems = eom.policy.lint_rates('governor.json', documents)
+        levels = [(level, name) for level, source, name, message in problems]
+        self.assertEqual(levels, [
+            (eom.policy.ERROR, 'missing_limits'),
+            (eom.policy.ERROR, 'bad_route'),
+            (eom.policy.WARNING, 'backwards'),
+
+            # Duplicate name, no methods, and shadowed by the first
+            # "backwards" since it has no route.
+            (eom.policy.ERROR, 'backwards'),
+            (eom.policy.ERROR, 'backwards'),
+            (eom.policy.ERROR, 'backwards'),
+        ])
+
+    def test_lint_acls(self):
+        rules = [
+            {'resource': 'queues', 'route': '/v1/queues(/[^/]+)?',
+             'acl': {'read': ['observer'], 'update': ['admin']}},
+            {'resource': 'queue', 'route': '/v1/queues/fizbit',
+             'acl': {'read': ['observer']}},
+            {'resource': 'health', 'route': '/v1/health', 'acl': {}},
+        ]
+
+        problems = eom.policy.lint_acls('rbac.json', rules)
+        levels = [(level, name) for level, source, name, message in problems]
+        self.assertEqual(levels, [
+            (eom.policy.WARNING, 'queues'),
+            (eom.policy.ERROR, 'health'),
+            (eom.policy.ERROR, 'queue'),
+        ])
+
+    def test_errors_block_output(self):
+        fd, rates_path = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as rates_file:
+            rates_file.write('[{"name": "broken"}]')
+
+        self.addCleanup(os.remove, rates_path)
+
+        args = ['--rates', rates_path, '-o', self.output_path]
+        self.assertEqual(eom.policy.main(args), 1)
+        self.assertFalse(os.path.exists(self.output_path))
+
+    def test_unreadable_files(self):
+        fd, bad_path = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as bad_file:
+            bad_file.write('{"eom_policy": 2, "rates": []}')
+
+        self.addCleanup(os.remove, bad_path)
+
+        stderr = self.useFixture(fixtures.StringStream('stderr'))
+        self.useFixture(fixtures.MonkeyPatch('sys.stderr', stderr.stream))
+
+        args = ['--rates', '/nonexistent', '--acls', bad_path,
+                '-o', self.output_path]
+        self.assertEqual(eom.policy.main(args), 1)
+        self.assertFalse(os.path.exists(self.output_path))
+
+        lines = stderr.getDetails()['stderr'].as_text().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith(
+            '/nonexistent: error: "rates": could not load rules: '))
+        self.assertTrue(lines[1].startswith(
+            bad_path + ': error: "acls": could not load rules: '))
+
+    def test_compiled_policy(self):
+        args = ['--rates', self.rates_path, '--acls', self.acls_path,
+                '-o', self.output_path]
+        self.assertEqual(eom.policy.main(args), 0)
+
+        for name in ('eom:governor', 'eom:rbac'):
+            option = 'rates_file' if name == 'eom:governor' else 'acls_file'
+            eom.governor.CONF.set_override(option, self.output_path,
+                                           group=name)
+            self.addCleanup(eom.governor.CONF.clear_override,
+                            option, group=name)
+
+        app = eom.rbac.wrap(eom.governor.wrap(util.app))
+
+        env = self.create_env('/v1/queues', 'queuing:observer',
+                              project_id='84197')
+        app(env, self.start_response)
+        self.assertEquals(self.status, '204 No Content')
+
+        env = self.create_env('/v1/queues', 'queuing:producer',
+                              project_id='84197')
+        app(env, self.start_response)
+        self.assertEquals(self.status, '403 Forbidden')
+
+        # The compiled policy can be linted again
+        args = ['--rates', self.output_path, '--acls', self.output_path]
+        self.assertEqual(eom.policy.main(args), 0)
+
+    def test_partial_policy(self):
+        args = ['--rates', self.rates_path, '-o', self.output_path]
+        self.assertEqual(eom.policy.main(args), 0)
+
+        with open(self.output_path) as fd:
+            self.assertNotIn('acls', json.load(fd))
+
+        self.assertTrue(eom.governor._load_rates(self.output_path, 5, 1))
+
+        # RBAC must not fail open with an empty list of rules
+        self.assertRaises(ValueError, eom.rbac._load_rules,
+                          self.output_path)
+
+    def test_get_section(self):
+        rules = [{'resource': 'queues'}]
+        self.assertIs(eom.rules.get_section(rules, 'acls'), rules)
+
+        policy = eom.policy.compile_policy(acls=rules)
+        self.assertIs(eom.rules.get_section(policy, 'acls'), rules)
+        self.assertRaises(ValueError, eom.rules.get_section,
+                          policy, 'rates')
+
+        for document in ({'eom_policy': 2, 'acls': rules}, {'acls': rules}):
+            self.assertRaises(ValueError, eom.rules.get_section,
+                              document, 'acls')
@@ -0,0 +1,102 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR ONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import os
+import signal
+
+import fixtures
+import simplejson as json
+
+import eom.governor
+import eom.profiler
+import eom.rbac
+from tests import util
+
+
+class TestProfiler(util.TestCase):
+
+    def _override(self, **overrides):
+        for name, value in overrides.items():
+            eom.profiler.CONF.set_override(name, value, group='eom:profiler')
+            self.addCleanup(eom.profiler.CONF.clear_override,
+                            name, group='eom:profiler')
+
+    def test_histogram(self):
+        histogram = eom.profiler.Histogram()
+        for sec in (0, 0.000003, 0.000003, 0.001, 3600):
+            histogram.record(sec)
+
+        self.assertEqual(histogram.count, 5)
+        self.assertEqual(histogram.counts[0], 1)
+        self.assertEqual(histogram.counts[2], 2)
+        self.assertEqual(histogram.counts[10], 1)
+        self.assertEqual(histogram.counts[-1], 1)
+
+        self.assertEqual(histogram.percentile(50), 4)
+        self.assertEqual(histogram.percentile(99),
+                         2 ** (eom.profiler.NUM_BUCKETS - 1))
+
+    def test_disabled(self):
+        self.assertIsNone(eom.profiler.get_profiler('governor'))
+        self.assertIs(eom.profiler.wrap(util.app), util.app)
+
+    def test_sampling(self):
+        self._override(sample_every=3)
+        stage_profiler = eom.profiler.get_profiler('sampled')
+
+        calls = []
+        dispatch = stage_profiler.sampled(lambda: calls.append('plain'),
+                                          lambda: calls.append('timed'))
+        for i in range(6):
+            dispatch()
+
+        self.assertEqual(calls, ['timed', 'plain', 'plain'] * 2)
+        self.assertEqual(stage_profiler.histogram('total').count, 2)
+
+    def test_stages(self):
+        self._override(sample_every=1, dump_path='/_eom/profile')
+
+        app = eom.rbac.wrap(eom.governor.wrap(util.app))
+
+        env = self.create_env('/v1/queues', 'queuing:observer',
+                              project_id='84197')
+        app(env, self.start_response)
+        self.assertEquals(self.status, '204 No Content')
+
+        body = app(self.create_env('/_eom/profile'), self.start_response)
+        self.assertEquals(self.status, '200 OK')
+
+        profiles = json.loads(''.join(body))
+        self.assertEqual(sorted(profiles['governor']),
+                         ['app', 'counters', 'middleware', 'sleep', 'total'])
+        self.assertEqual(profiles['governor']['counters']['count'], 1)
+        self.assertEqual(profiles['governor']['sleep']['count'], 0)
+
+        self.assertEqual(sorted(profiles['rbac']),
+                         ['app', 'middleware', 'total'])
+        self.assertEqual(profiles['rbac']['total']['count'], 1)
+
+    def test_dump_signal(self):
+        self._override(sample_every=1, dump_signal='SIGUSR2')
+        self.addCleanup(signal.signal, signal.SIGUSR2, signal.SIG_DFL)
+        self.addCleanup(eom.profiler._SIGNAL_INSTALLED.remove, 'SIGUSR2')
+
+        logger = self.useFixture(fixtures.FakeLogger(level=logging.INFO))
+        eom.profiler.get_profiler('signaled')
+
+        os.kill(os.getpid(), signal.SIGUSR2)
+        self.assertIn('"signaled"', logger.output)
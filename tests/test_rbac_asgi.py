@@ -0,0 +1,187 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR ONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+try:
+    import asyncio
+except ImportError:
+    # Python 2
+    asyncio = None
+try:
+    import httplib
+except ImportError:
+    import http.client as httplib
+import os
+import shutil
+import tempfile
+
+import eom.policy
+import eom.rbac_asgi
+from tests import test_rbac
+
+_204_NO_CONTENT = (
+    {'type': 'http.response.start', 'status': 204, 'headers': []},
+    {'type': 'http.response.body', 'body': b''},
+)
+
+
+class Ready(object):
+    """Awaitable that suspends once, then completes."""
+
+    def __await__(self):
+        return iter([None])
+
+
+def run(awaitable):
+    """Drives an awaitable to completion without an event loop."""
+    for value in awaitable.__await__():
+        pass
+
+
+def app(scope, receive, send):
+    return eom.rbac_asgi._Response(send, _204_NO_CONTENT)
+
+
+def to_scope(env):
+    """Translates a WSGI environ into an ASGI HTTP scope."""
+    headers = []
+    for key, name in (('HTTP_X_ROLES', b'x-roles'),
+                      ('HTTP_X_PROJECT_ID', b'x-project-id')):
+        if key in env:
+            headers.append((name, env[key].encode('latin-1')))
+
+    return {
+        'type': 'http',
+        'method': env['REQUEST_METHOD'],
+        'path': env['PATH_INFO'],
+        'headers': headers,
+    }
+
+
+# NOTE(kgriffs): Inherits all of the WSGI middleware's tests, running
+# them against the ASGI middleware through a thin WSGI shim.
+class TestRBACASGI(test_rbac.TestRBAC):
+
+    def setUp(self):
+        super(TestRBACASGI, self).setUp()
+
+        self.asgi_rbac = eom.rbac_asgi.wrap(app)
+        self.rbac = self._call
+
+    def _create_send(self, messages):
+        def send(message):
+            messages.append(message)
+            return Ready()
+
+        return send
+
+    def _run(self, awaitable):
+        run(awaitable)
+
+    def _call(self, env, start_response):
+        messages = []
+        send = self._create_send(messages)
+
+        self._run(self.asgi_rbac(to_scope(env), None, send))
+
+        start = messages[0]
+        self.assertEqual(start['type'], 'http.response.start')
+        self.assertEqual(messages[-1]['type'], 'http.response.body')
+
+        status = start['status']
+        start_response('%d %s' % (status, httplib.responses[status]),
+                       start['headers'])
+        return []
+
+    def test_compiled_policy(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        policy_path = os.path.join(temp_dir, 'eom.policy')
+
+        args = ['--acls', self.conf_path('rbac.json-sample'),
+                '-o', policy_path]
+        self.assertEqual(eom.policy.main(args), 0)
+
+        eom.rbac_asgi.CONF.set_override('acls_file', policy_path,
+                                        group='eom:rbac')
+        self.addCleanup(eom.rbac_asgi.CONF.clear_override,
+                        'acls_file', group='eom:rbac')
+
+        self.asgi_rbac = eom.rbac_asgi.wrap(app)
+
+        env = self.create_env('/v1/queues', 'queuing:observer')
+        self.rbac(env, self.start_response)
+        self.assertEquals(self.status, '204 No Content')
+
+        env = self.create_env('/v1/queues', 'queuing:producer')
+        self.rbac(env, self.start_response)
+        self.assertEquals(self.status, '403 Forbidden')
+
+    def test_not_http(self):
+        scope = {'type': 'lifespan'}
+        sentinel = object()
+
+        rbac = eom.rbac_asgi.wrap(lambda scope, receive, send: sentinel)
+        self.assertIs(rbac(scope, None, None), sentinel)
+
+    def test_response_delegation(self):
+        results = []
+
+        class Echo(object):
+            def __await__(self):
+                results.append((yield 'suspended'))
+
+        response = eom.rbac_asgi._Response(lambda message: Echo(), [{}, {}])
+        iterator = response.__await__()
+
+        self.assertEqual(next(iterator), 'suspended')
+        self.assertEqual(iterator.send('first'), 'suspended')
+        self.assertRaises(StopIteration, iterator.send, 'second')
+        self.assertEqual(results, ['first', 'second'])
+
+        # Errors are passed on to whatever is being awaited
+        iterator = response.__await__()
+        next(iterator)
+        self.assertRaises(ValueError, iterator.throw, ValueError)
+
+
+class TestRBACASGIEventLoop(TestRBACASGI):
+    """Runs the same tests under a real asyncio event loop."""
+
+    def setUp(self):
+        super(TestRBACASGIEventLoop, self).setUp()
+
+        if asyncio is None:
+            self.skipTest('asyncio is not available')
+
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def _create_send(self, messages):
+        loop = self.loop
+
+        def send(message):
+            messages.append(message)
+
+            # NOTE(kgriffs): Complete on a later turn of the loop, as
+            # a server writing to a socket would.
+            future = loop.create_future()
+            loop.call_soon(future.set_result, None)
+            return future
+
+        return send
+
+    def _run(self, awaitable):
+        self.loop.run_until_complete(awaitable)
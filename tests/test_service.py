@@ -0,0 +1,97 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR ONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import multiprocessing
+import struct
+import time
+
+import eom.service
+from tests import util
+
+INTERVAL_SEC = 0.01
+
+
+class Counter(eom.service.Service):
+
+    def __init__(self, fail=False):
+        super(Counter, self).__init__(INTERVAL_SEC)
+
+        self.ticks = 0
+        self.prepared = []
+        self.fail = fail
+
+    def tick(self):
+        self.ticks += 1
+        if self.fail:
+            raise struct.error()
+
+    def _prepare(self, forked):
+        self.prepared.append(forked)
+
+
+class TestService(util.TestCase):
+
+    def test_start_stop(self):
+        service = Counter()
+        service.start()
+        service.start()
+        self.assertEqual(service.prepared, [False])
+
+        time.sleep(INTERVAL_SEC * 5)
+        service.stop()
+        self.assertFalse(service._thread.is_alive())
+
+        # One last tick on the way out
+        ticks = service.ticks
+        self.assertTrue(ticks > 1)
+        time.sleep(INTERVAL_SEC * 5)
+        self.assertEqual(service.ticks, ticks)
+
+    def test_stop_not_started(self):
+        service = Counter()
+        service.stop()
+        self.assertEqual(service.ticks, 0)
+
+    def test_survives_errors(self):
+        service = Counter(fail=True)
+        service.start()
+
+        time.sleep(INTERVAL_SEC * 5)
+        self.assertTrue(service.ticks > 1)
+        self.assertTrue(service._thread.is_alive())
+
+        service.fail = False
+        service.stop()
+
+    def test_fork(self):
+        service = Counter()
+        self.addCleanup(service.stop)
+        service.start()
+
+        results = multiprocessing.Queue()
+
+        def child():
+            parent_thread = service._thread
+            service.start()
+            results.put((service.prepared,
+                         service._thread is not parent_thread and
+                         service._thread.is_alive()))
+
+        process = multiprocessing.Process(target=child)
+        process.start()
+        process.join()
+
+        self.assertEqual(results.get(timeout=5), ([False, True], True))
@@ -0,0 +1,222 @@
+# Copyright (c) 2013 Rackspace, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR ONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import multiprocessing
+import os
+import shutil
+import struct
+import tempfile
+import time
+
+import fixtures
+
+import eom.governor
+import eom.snapshot
+from tests import util
+
+PERIOD_SEC = 5
+
+
+class TestSnapshot(util.TestCase):
+
+    def setUp(self):
+        super(TestSnapshot, self).setUp()
+
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        self.path = os.path.join(temp_dir, 'governor.snapshot')
+
+        self.now = time.time()
+        self.epoch = int(self.now / PERIOD_SEC)
+
+    def _create_cache(self):
+        cache = eom.governor.Cache()
+        cache.get_counters('84197', 'default')[:] = [self.epoch, 3, 10, 0]
+        cache.get_counters(('84197', 'kgriffs'), 'bulk')[:] = [
+            self.epoch - 1, 8, 0, 0]
+
+        return cache
+
+    def test_round_trip(self):
+        eom.snapshot.save(self._create_cache(), self.path)
+
+        cache = eom.governor.Cache()
+        loaded = eom.snapshot.load(cache, self.path, PERIOD_SEC, self.now)
+
+        self.assertEqual(loaded, 2)
+        self.assertEqual(cache.store, self._create_cache().store)
+
+    def test_concurrent_writers(self):
+        def writer():
+            for i in range(200):
+                eom.snapshot.save(self._create_cache(), self.path)
+
+        process = multiprocessing.Process(target=writer)
+        process.start()
+
+        for i in range(200):
+            eom.snapshot.save(self._create_cache(), self.path)
+            eom.snapshot.load(eom.governor.Cache(), self.path, PERIOD_SEC)
+
+        process.join()
+        self.assertEqual(process.exitcode, 0)
+
+        # No temporary files are left behind
+        self.assertEqual(os.listdir(os.path.dirname(self.path)),
+                         ['governor.snapshot'])
+
+    def test_discard_old(self):
+        cache = self._create_cache()
+        cache.get_counters('5678', 'default')[:] = [self.epoch - 2, 9, 9, 0]
+        cache.get_counters('1234', 'default')[:] = [
+            self.epoch - 2, 9, 9, self.now + 30]
+
+        eom.snapshot.save(cache, self.path)
+
+        cache = eom.governor.Cache()
+        eom.snapshot.load(cache, self.path, PERIOD_SEC, self.now)
+
+        self.assertNotIn(('5678', 'default'), cache.store)
+
+        # Still in the penalty box, so keep it around
+        self.assertTrue(cache.is_throttled('1234', 'default', self.now))
+
+    def test_windows(self):
+        window_sec = PERIOD_SEC * 1000
+        window_epoch = int(self.now / window_sec)
+
+        cache = self._create_cache()
+        cache.get_counters('5678', 'daily')[:] = [
+            self.epoch - 2, 9, 9, 0, window_sec, window_epoch, 40]
+        cache.get_counters('1234', 'daily')[:] = [
+            self.epoch - 2000, 9, 9, 0, window_sec, window_epoch - 1, 40]
+
+        eom.snapshot.save(cache, self.path)
+
+        loaded = eom.governor.Cache()
+        eom.snapshot.load(loaded, self.path, PERIOD_SEC, self.now)
+
+        # Keep old counters around while their window is still open
+        self.assertEqual(loaded.get_counters('5678', 'daily'),
+                         cache.get_counters('5678', 'daily'))
+        self.assertNotIn(('1234', 'daily'), loaded.store)
+
+    def test_corrupt(self):
+        eom.snapshot.save(self._create_cache(), self.path)
+        with open(self.path, 'r+b') as fd:
+            fd.truncate(os.path.getsize(self.path) - 4)
+
+        cache = eom.governor.Cache()
+        loaded = eom.snapshot.load(cache, self.path, PERIOD_SEC, self.now)
+        self.assertEqual(loaded, 1)
+
+        with open(self.path, 'wb') as fd:
+            fd.write('junk')
+
+        self.assertEqual(eom.snapshot.load(cache, self.path, PERIOD_SEC), 0)
+        self.assertEqual(eom.snapshot.load(cache, self.path + '.missing',
+                                           PERIOD_SEC), 0)
+
+    def test_snapshotter(self):
+        cache = self._create_cache()
+        snapshotter = eom.snapshot.Snapshotter(cache, self.path, 0.01)
+        snapshotter.start()
+
+        time.sleep(0.1)
+        self.assertTrue(os.path.exists(self.path))
+
+        cache.get_counters('84197', 'default')[1] = 4
+        snapshotter.stop()
+
+        cache = eom.governor.Cache()
+        eom.snapshot.load(cache, self.path, PERIOD_SEC, self.now)
+        self.assertEqual(cache.get_counters('84197', 'default')[1], 4)
+
+    def test_fork(self):
+        snapshotter = eom.snapshot.Snapshotter(eom.governor.Cache(),
+                                               self.path, 3600)
+        self.addCleanup(snapshotter.stop)
+        snapshotter.start()
+        snapshotter.start()
+
+        results = multiprocessing.Queue()
+
+        def child():
+            parent_thread = snapshotter._thread
+            snapshotter.start()
+            results.put(snapshotter._thread is not parent_thread and
+                        snapshotter._thread.is_alive())
+
+        process = multiprocessing.Process(target=child)
+        process.start()
+        process.join()
+
+        self.assertTrue(results.get(timeout=5))
+
+    def test_survives_errors(self):
+        def fail(cache, path):
+            raise struct.error()
+
+        self.useFixture(fixtures.MonkeyPatch('eom.snapshot.save', fail))
+
+        snapshotter = eom.snapshot.Snapshotter(eom.governor.Cache(),
+                                               self.path, 0.01)
+        snapshotter.start()
+        time.sleep(0.05)
+
+        self.assertTrue(snapshotter._thread.is_alive())
+        snapshotter._stopped.set()
+
+    def test_stop_not_started(self):
+        snapshotter = eom.snapshot.Snapshotter(eom.governor.Cache(),
+                                               self.path, 3600)
+        snapshotter.stop()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_warm_start(self):
+        cache = eom.governor.Cache()
+        cache.get_counters('84197', 'default')[:] = [
+            int(time.time() / PERIOD_SEC), 0, 0, time.time() + 30]
+        eom.snapshot.save(cache, self.path)
+
+        overrides = {
+            'snapshot_file': self.path,
+            'snapshot_interval_sec': 3600,
+        }
+
+        for name, value in overrides.items():
+            eom.governor.CONF.set_override(name, value,
+                                           group='eom:governor')
+            self.addCleanup(eom.governor.CONF.clear_override,
+                            name, group='eom:governor')
+
+        # NOTE(kgriffs): Stop the services started by the governor at
+        # the end of the test, rather than at exit, by which time the
+        # temporary directory they write to has been removed.
+        exit_funcs = []
+        self.useFixture(fixtures.MonkeyPatch('atexit.register',
+                                             exit_funcs.append))
+        self.addCleanup(lambda: [func() for func in exit_funcs])
+
+        governor = eom.governor.wrap(util.app)
+
+        env = self.create_env('/v1', project_id='84197')
+        governor(env, self.start_response)
+        self.assertEquals(self.status, '429 Too Many Requests')
+
+        env = self.create_env('/v1', project_id='5678')
+        governor(env, self.start_response)
+        self.assertEquals(self.status, '204 No Content')